@@ -1,27 +1,102 @@
-import requests
+import asyncio
+import contextvars
 import csv
+import logging
+import os
+import re
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+# Internal functions
+import checkpoints
+import deadlines
+import harvest_metrics
+import http_client
+import response_models
+import run_results
+from gbif_networks import network_key, networks
+
+
+# Defining GBIF endpoints, the base urls can be pointed elsewhere (e.g. the stand-in server)
+gbif_api = os.environ.get('GBIF_API_URL', 'https://api.gbif.org/v1')
+gbif_portal_api = os.environ.get('GBIF_PORTAL_API_URL', 'https://www.gbif.org/api')
+
+gbif_dataset = gbif_api + '/dataset/search'
+gbif_specimen = gbif_portal_api + '/occurrence/breakdown'
+
+# Maximum number of breakdown requests that are handled at the same time
+# The number actually in flight per host is adapted by the http client to what the host sustains
+max_concurrency = 16
+
+# Dataset and constituents paging, GBIF returns at most 1000 datasets per page
+dataset_page_size = 1000
+dataset_prefetch = 4
+
+# Basis of record used as breakdown filter, breakdown values follow this order
+basis_of_record = ['PRESERVED_SPECIMEN', 'FOSSIL_SPECIMEN', 'LIVING_SPECIMEN', 'MATERIAL_SAMPLE']
+issues_file = 'csv_files/sources/GBIF_issues.csv'
+
+# DiSSCo spreadsheet matching GBIF publishers with their name and ROR id, indexed once per file version
+microchanges_file = 'csv_files/sources/microchanges.csv'
+publisher_indexes: dict = {}
+
+
+def network_url(network: str) -> str:
+    """ The GBIF API url of a network
+        :return: The url
+    """
 
+    return gbif_api + '/network/' + network
 
-# Defining GBIF endpoints
-network_key = '17abcf75-2f1e-46dd-bf75-a5b21dd02655'
-gbif_institution = 'https://api.gbif.org/v1/network/' + network_key
-gbif_dataset = 'https://api.gbif.org/v1/dataset/search'
-gbif_specimen = 'https://www.gbif.org/api/occurrence/breakdown'
 
-# Base query for GBIF
-base_query = {
-    'network_key': network_key,
-    'limit': 1000,
-    'offset': 0
-}
+def network_query(network: str) -> dict:
+    """ Base query of the occurrence breakdowns of a network
+        :return: The network filter and paging of a breakdown
+    """
+
+    return {
+        'network_key': network,
+        'limit': 1000,
+        'offset': 0
+    }
+
+
+def harvest_networks(stage, keys: list = None, **kwargs) -> dict:
+    """ Runs a harvest stage for several GBIF networks at the same time
+        The networks share the connection pools, response cache and adaptive limits of the http client
+        :param stage: One of the gather_* functions
+        :param keys: Keys of the networks, defaults to the configured networks
+        :param kwargs: Further arguments of the stage
+        :return: A dict of each network key and its result
+    """
 
+    keys = keys or networks
 
-def gather_datasets() -> dict:
+    def run_stage(network: str):
+        return stage(network=network, **kwargs)
+
+    return dict(zip(keys, asyncio.run(fan_out(run_stage, keys, len(keys)))))
+
+
+@run_results.memoized()
+@deadlines.budgeted
+@checkpoints.checkpointed('gbif_datasets')
+@harvest_metrics.harvester
+def gather_datasets(faceted: bool = True, network: str = network_key) -> dict:
     """ Searches in GBIF for the number of datasets belonging to DiSSCo and saves this
-        Uses the number to iterate through the datasets, adding up the total per country
-        Saves the data in the global 'data' dict
+        By default, lets GBIF count the datasets per country with a single faceted search
+        Otherwise, streams through the datasets, adding up the total per country
+        :param faceted: Whether to use the faceted search instead of paging through all datasets
+        :param network: Key of the GBIF network
+        :return total_datasets: A dict of the total and the totals per country
     """
 
+    if faceted:
+        return run_queries(['datasets_per_country'], network=network)['datasets_per_country']
+
     # Data definition
     total_datasets: dict = {
         'total': 0,
@@ -29,209 +104,653 @@ def gather_datasets() -> dict:
     }
 
     # Initial query for dataset count
-    query: dict = {'network_key': '17abcf75-2f1e-46dd-bf75-a5b21dd02655', 'limit': 1}
-    response = requests.get(gbif_dataset, params=query).json()
+    total_datasets['total'] = count_datasets(network=network)
 
-    total_datasets['total'] = response['count']
-    i = 0
+    # Count datasets per country while the pages come in
+    for dataset in iterate_datasets(total_datasets['total'], network=network):
+        if dataset.publishing_country not in total_datasets['countries']:
+            total_datasets['countries'][dataset.publishing_country] = 0
 
-    # Gather all datasets per 1000 (GBIF max)
-    while i < total_datasets['total']:
-        query = {'network_key': '17abcf75-2f1e-46dd-bf75-a5b21dd02655', 'limit': 1000, 'offset': i}
-        response = requests.get(gbif_dataset, params=query).json()
+        total_datasets['countries'][dataset.publishing_country] += 1
 
-        # Iterate through datasets and gather information
-        for dataset in response['results']:
-            # Count datasets per country
-            if dataset['publishingCountry'] not in total_datasets['countries']:
-                total_datasets['countries'][dataset['publishingCountry']] = 0
+    return total_datasets
 
-            total_datasets['countries'][dataset['publishingCountry']] += 1
-            i += 1
 
-    return total_datasets
+def count_datasets(network: str = network_key) -> int:
+    """ Internal function of gather_datasets()
+        Requests a single dataset to find out the total number of datasets of the network
+        :param network: Key of the GBIF network
+        :return: The number of datasets
+    """
 
+    query: dict = {'network_key': network, 'limit': 1}
+    response = http_client.get_json(gbif_dataset, params=query)
 
-def gather_specimens() -> dict:
-    """ Searches in GBIF for the number of specimens belonging to DiSSCo and saves this
-        Filters the results based on the basis of record property and orders by country
-        Uses this data to iterate through the countries to calculate their specimen total
-        Finally, categorizes these totals using basis of record
-        Saves the data in the global 'data' dict
+    return response['count']
+
+
+def iterate_datasets(count: int, prefetch: int = dataset_prefetch, network: str = network_key):
+    """ Generator that pages through all datasets of the network in GBIF
+        :param count: The total number of datasets, from count_datasets()
+        :param prefetch: Number of pages that are requested ahead
+        :param network: Key of the GBIF network
+        :return: Yields the dataset records one at a time
     """
 
-    # Data definition
-    total_specimens: dict = {
-        'total': {},
-        'countries': {}
-    }
+    return iterate_pages(gbif_dataset, {'network_key': network}, count, prefetch)
 
-    # Gather number of specimens per publishing country and filtered on basis of record
-    basis_of_record = ['PRESERVED_SPECIMEN', 'FOSSIL_SPECIMEN', 'LIVING_SPECIMEN', 'MATERIAL_SAMPLE']
-    query: dict = base_query | {
-        'basis_of_record': basis_of_record,
-        'advanced': True,
-        'dimension': 'publishing_country',
-        'secondDimension': 'basis_of_record'
-    }
 
-    response = requests.get(gbif_specimen, params=query).json()
+def iterate_pages(url: str, query: dict, count: int, prefetch: int = dataset_prefetch):
+    """ Generator that pages through a paged GBIF listing
+        All page offsets follow from the count, the next pages are requested while the current one is handled
+        :param url: The listing endpoint
+        :param query: The query, without limit and offset
+        :param count: The total number of records in the listing
+        :param prefetch: Number of pages that are requested ahead
+        :return: Yields the records one at a time
+    """
 
-    # Iterate through the countries to calculate the total amount of specimens
-    for country in response['results']:
-        total_specimens['countries'][country['filter']['publishing_country']] = {
-            'total': country['count']
-        }
+    offsets = iter(range(0, count, dataset_page_size))
+    pending = deque()
 
-        # Group the totals of countries by basis of record
-        i = 0
-        for bor in basis_of_record:
-            if total_specimens['total'].get(bor) is None:
-                total_specimens['total'][bor] = country['values'][i]
-            else:
-                total_specimens['total'][bor] += country['values'][i]
+    with ThreadPoolExecutor(max_workers=max(1, prefetch)) as executor:
+        for offset in islice(offsets, max(1, prefetch)):
+            pending.append(executor.submit(contextvars.copy_context().run, get_page, url, query, offset))
 
-            total_specimens['countries'][country['filter']['publishing_country']][bor] = country['values'][i]
-            i += 1
+        while pending:
+            page = pending.popleft().result()
 
-    return total_specimens
+            # Keep the number of requested pages topped up
+            offset = next(offsets, None)
+
+            if offset is not None:
+                pending.append(executor.submit(contextvars.copy_context().run, get_page, url, query, offset))
+
+            yield from page
 
+            # Release the page before waiting on the next one
+            del page
+
+
+def get_page(url: str, query: dict, offset: int) -> list:
+    """ Internal function of iterate_pages()
+        Requests one page of a GBIF listing
+        :return: The datasets of the page
+    """
 
-def gather_issues_flags() -> dict:
+    # Pages are not kept for the rest of the run, so only the pages being iterated are held in memory
+    page = http_client.get_decoded(url, query | {'limit': dataset_page_size, 'offset': offset},
+                                   response_models.decode_dataset_page, keep=False)
+
+    return page.results
+
+
+@run_results.memoized()
+@deadlines.budgeted
+@checkpoints.checkpointed('gbif_specimens')
+@harvest_metrics.harvester
+def gather_specimens(network: str = network_key) -> dict:
+    """ Searches in GBIF for the number of specimens belonging to DiSSCo and saves this
+        Filters the results based on the basis of record property and orders by country
+        Calculates the specimen total of each country, categorized by basis of record
+        :param network: Key of the GBIF network
+        :return total_specimens: A dict of the totals and the totals per country
+    """
+
+    return run_queries(['specimens_per_country'], network=network)['specimens_per_country']
+
+
+@run_results.memoized(ignore=('concurrency',), answered_by={'monthly_progress': {False: True}})
+@deadlines.budgeted
+@checkpoints.checkpointed('gbif_issues_flags', ignore=('concurrency',))
+@harvest_metrics.harvester
+def gather_issues_flags(concurrency: int = max_concurrency, monthly_progress: bool = True,
+                        network: str = network_key, shard: tuple = None) -> dict:
     """ Searches in GBIF for the number of publishing countries belonging to DiSSCo
-        Iterates through this data to call on the issues and flags belonging to each country
+        Calls on the issues and flags belonging to each country concurrently
         Finally, calculates the totals per issue or flag from a country
-        Saves the data in the global 'data' dict
+        Without monthly progress, all countries are answered by a single breakdown request
+        :param concurrency: Maximum number of country requests that run at the same time
+        :param monthly_progress: Whether to include the progress per month of every issue or flag
+        :param network: Key of the GBIF network
+        :param shard: Tuple of the index and number of shards, to harvest only the countries of one shard
+            with monthly progress
+        :return issues_and_flags: A dict of the totals per country
     """
 
+    if not monthly_progress:
+        return run_queries(['issues_per_country'], network=network)['issues_per_country']
+
     # Data definition
     issues_and_flags: dict = {
         'total': 0, 'countries': {}
     }
 
     # Gather all publishing countries of DiSSCo
-    query: dict = base_query | {
-        'advanced': True,
-        'dimension': 'publishing_country'
-    }
-    response = requests.get(gbif_specimen, params=query).json()
+    country_codes = [
+        country_code for country_code in run_queries(['publishing_countries'], network=network)['publishing_countries']
+        if in_shard(country_code, shard)
+    ]
 
-    # Iterate through countries
-    for country in response['results']:
-        country_code = country['filter']['publishing_country']
-
-        # Gather issues and flags per country
-        c_query: dict = base_query | {
-            'publishing_country': country_code,
-            'advanced': True,
-            'dimension': 'issue',
-            'secondDimension': 'month'
-        }
-        response = requests.get(gbif_specimen, params=c_query).json()
+    # Gather issues and flags of all countries at once
+    breakdowns = asyncio.run(fan_out(partial(gather_country_issues_flags, network=network), country_codes, concurrency))
 
+    # Iterate through countries
+    for country_code, breakdown in zip(country_codes, breakdowns):
         issues_and_flags['countries'][country_code] = {
             'total': 0
         }
 
         # Store total issues and flags per country
-        for issue_flag in response['results']:
+        for issue_flag in breakdown:
             issues_and_flags['countries'][country_code]['total'] \
-                += issue_flag['count']
+                += issue_flag.count
 
-            issues_and_flags['countries'][country_code][issue_flag['displayName']] = {
-                'total': issue_flag['count'],
+            issues_and_flags['countries'][country_code][issue_flag.display_name] = {
+                'total': issue_flag.count,
                 'monthly_progress': {}
             }
 
-            issues_and_flags['total'] += issue_flag['count']
+            issues_and_flags['total'] += issue_flag.count
 
             # Gather process over time (per month)
             m = 1
 
             while m <= 12:
-                issues_and_flags['countries'][country_code][issue_flag['displayName']]['monthly_progress'][m] \
-                    = issue_flag['values'][m - 1]
+                issues_and_flags['countries'][country_code][issue_flag.display_name]['monthly_progress'][m] \
+                    = issue_flag.values[m - 1]
                 m += 1
 
     return issues_and_flags
 
 
+@checkpoints.checkpointed('gbif_country_issues_flags')
+def gather_country_issues_flags(country_code: str, network: str = network_key) -> list:
+    """ Internal function of gather_issues_flags()
+        Requests the issues and flags of one publishing country, broken down per month
+        :return: Returns the breakdown rows of the country
+    """
+
+    c_query: dict = network_query(network) | {
+        'publishing_country': country_code,
+        'advanced': True,
+        'dimension': 'issue',
+        'secondDimension': 'month'
+    }
+
+    return http_client.get_decoded(gbif_specimen, c_query, response_models.decode_breakdown)
+
+
+def in_shard(key: str, shard: tuple = None) -> bool:
+    """ Finds whether a country or publisher is harvested by a shard
+        Keys are spread over the shards by a checksum, so every process agrees on the shard of a key
+        :param key: Country code or publisher key
+        :param shard: Tuple of the index and number of shards, None when the harvest is not sharded
+        :return: Whether the key belongs to the shard
+    """
+
+    if shard is None:
+        return True
+
+    index, count = shard
+
+    return zlib.crc32(str(key).encode('utf-8')) % count == index
+
+
+async def fan_out(function, items: list, concurrency: int = max_concurrency) -> list:
+    """ Calls on the blocking function for every item in a pool of worker threads
+        Never more than the given concurrency of calls are running at the same time
+        :return: Returns the results in the same order as the items
+    """
+
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        # Every call runs in a copy of the current context, keeping the metrics caller label
+        return await asyncio.gather(*(
+            loop.run_in_executor(executor, contextvars.copy_context().run, function, item) for item in items
+        ))
+
+
 # Function could be divided into separate functions
 # Publishers replace institutions until further notice
-def gather_institutions() -> dict:
+@run_results.memoized(ignore=('concurrency',), answered_by={'monthly_progress': {False: True}})
+@deadlines.budgeted
+@checkpoints.checkpointed('gbif_institutions', ignore=('concurrency',))
+@harvest_metrics.harvester
+def gather_institutions(monthly_progress: bool = True, concurrency: int = max_concurrency,
+                        network: str = network_key, shard: tuple = None) -> dict:
     """ Questions GBIF API and requests data from publishers within the DiSSCo network
         Handles the data and reforms these to a usable format
+        :param monthly_progress: Whether to include the progress per month of every issue or flag
+        :param concurrency: Maximum number of publisher requests that run at the same time
+        :param network: Key of the GBIF network
+        :param shard: Tuple of the index and number of shards, to harvest only the publishers of one shard
         :return publishers: A dict of the refined data
     """
 
-    # List all datasets of DiSSCo network and filter on publishing organisations
-    query: dict = {'limit': 1000}
-    response = requests.get(gbif_institution + '/constituents', params=query).json()
+    # Calculate metrics for basis of record per publisher and, without monthly progress, issues/flags
+    metrics = ['basis_of_record_per_publisher']
+
+    if not monthly_progress:
+        metrics.append('issues_per_publisher')
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Request the metrics while paging through the datasets
+        planned = executor.submit(contextvars.copy_context().run, run_queries, metrics, concurrency, network)
+
+        # List all datasets of DiSSCo network and filter on publishing organisations
+        publishers: dict = {}
 
-    publishers: dict = {}
+        # Iterate through datasets to count total per publisher
+        for dataset in iterate_constituents(count_constituents(network), network=network):
+            if not in_shard(dataset.publishing_organization_key, shard):
+                continue
 
-    # Iterate through datasets to count total per publisher
-    for dataset in response['results']:
-        if not publishers.get(dataset['publishingOrganizationKey']):
-            publishers[dataset['publishingOrganizationKey']] = {
-                'gbif_id': dataset['publishingOrganizationKey'],
-                'totals': {
-                    'datasets': 1
+            if not publishers.get(dataset.publishing_organization_key):
+                publishers[dataset.publishing_organization_key] = {
+                    'gbif_id': dataset.publishing_organization_key,
+                    'totals': {
+                        'datasets': 0
+                    }
                 }
-            }
 
-        # Add up to total datasets
-        publishers[dataset['publishingOrganizationKey']]['totals']['datasets'] += 1
+            # Add up to total datasets
+            publishers[dataset.publishing_organization_key]['totals']['datasets'] += 1
+
+        results = planned.result()
 
     # Match GBIF publishers with their ROR id from DiSSCo spreadsheet
-    csv_file = "csv_files/sources/microchanges.csv"
+    publisher_index = load_publisher_index()
+    unmatched = []
+
+    for publisher in publishers:
+        if publisher in publisher_index:
+            publishers[publisher] |= publisher_index[publisher]
+        else:
+            unmatched.append(publisher)
+
+    if unmatched:
+        logging.warning(f'{len(unmatched)} GBIF publishers are missing from {microchanges_file}: {", ".join(unmatched)}')
+
+    for publishing_org, totals in results['basis_of_record_per_publisher'].items():
+        if not in_shard(publishing_org, shard):
+            continue
+
+        publishers[publishing_org]['totals'] |= totals
+
+        if not monthly_progress:
+            publishers[publishing_org]['issues_and_flags'] = results['issues_per_publisher'].get(publishing_org, {})
+
+    if not monthly_progress:
+        return publishers
+
+    # Find issues and flags of all publishers at once
+    publishing_orgs = [
+        publishing_org for publishing_org in results['basis_of_record_per_publisher'] if in_shard(publishing_org, shard)
+    ]
+    breakdowns = asyncio.run(fan_out(partial(gather_publisher_issues_flags, network=network), publishing_orgs,
+                                     concurrency))
+
+    for publishing_org, breakdown in zip(publishing_orgs, breakdowns):
+        # Set issues and flags values
+        publishers[publishing_org]['issues_and_flags'] = {}
+
+        for issue_flag in breakdown:
+
+            publishers[publishing_org]['issues_and_flags'][issue_flag.display_name] \
+                = {'total': issue_flag.count, 'monthly_progress': list(issue_flag.values[:12])}
+
+    return publishers
+
+
+@checkpoints.checkpointed('gbif_publisher_issues_flags')
+def gather_publisher_issues_flags(publishing_org: str, network: str = network_key) -> list:
+    """ Internal function of gather_institutions()
+        Requests the issues and flags of one publisher, broken down per month
+        :return: Returns the breakdown rows of the publisher
+    """
+
+    c_query: dict = network_query(network) | {
+        'publishingOrg': publishing_org,
+        'advanced': True,
+        'dimension': 'issue',
+        'secondDimension': 'month'
+    }
+
+    return http_client.get_decoded(gbif_specimen, c_query, response_models.decode_breakdown)
+
+
+def count_constituents(network: str = network_key) -> int:
+    """ Internal function of gather_institutions()
+        Requests a single constituent dataset to find out the total number of datasets in the network
+        :return: The number of constituent datasets
+    """
+
+    response = http_client.get_json(network_url(network) + '/constituents', params={'limit': 1})
+
+    return response['count']
+
+
+def iterate_constituents(count: int, prefetch: int = dataset_prefetch, network: str = network_key):
+    """ Generator that pages through all constituent datasets of the network
+        :param count: The total number of constituents, from count_constituents()
+        :param prefetch: Number of pages that are requested ahead
+        :param network: Key of the GBIF network
+        :return: Yields the dataset records one at a time
+    """
+
+    return iterate_pages(network_url(network) + '/constituents', {}, count, prefetch)
+
+
+def load_publisher_index(csv_file: str = microchanges_file) -> dict:
+    """ Parses the DiSSCo spreadsheet into a lookup of GBIF publisher key to name and ROR id
+        Both the main and the additional GBIF publisher ids of a row are indexed
+        The index is reused for as long as the file is not modified
+        :return index: A dict of the GBIF publisher key to its name and ror_id
+    """
+
+    modified = os.path.getmtime(csv_file)
+
+    if csv_file in publisher_indexes and publisher_indexes[csv_file][0] == modified:
+        return publisher_indexes[csv_file][1]
+
+    index: dict = {}
 
     with open(csv_file, 'r', newline='', encoding='utf-8') as file:
+        reader = csv.reader(file)
+        headers = next(reader)
+        key_columns = [headers.index('GBIF PUBLISHER ID'), headers.index('ADDITIONAL GBIF PUBLISHER IDs')]
+
+        for row in reader:
+            for column in key_columns:
+                for key in re.split(r'[\s,;]+', row[column]):
+                    if key:
+                        index[key] = {
+                            'name': row[4],
+                            'ror_id': row[5]
+                        }
+
+    publisher_indexes[csv_file] = (modified, index)
+
+    return index
+
+
+# Query planner
+# Every metric names the request that answers it and how to reshape the response
+# Metrics answered by the same request are fetched only once
+
+def plan_queries(metrics: list, network: str = network_key) -> dict:
+    """ Plans the minimum set of GBIF requests that answers all requested metrics
+        Metrics that are answered by an identical faceted or breakdown request share that request
+        :param metrics: Names of the metrics, as defined in planned_metrics
+        :param network: Key of the GBIF network
+        :return plan: A dict of the canonical request url to its endpoint, query and metrics
+    """
+
+    plan: dict = {}
+
+    for metric in metrics:
+        endpoint, query = planned_metrics[metric]['query'](network)
+        request_url = http_client.canonical_url(endpoint, query)
+
+        if request_url not in plan:
+            plan[request_url] = {
+                'endpoint': endpoint,
+                'query': query,
+                'decode': planned_metrics[metric]['decode'],
+                'metrics': []
+            }
+
+        plan[request_url]['metrics'].append(metric)
+
+    return plan
+
+
+def run_queries(metrics: list, concurrency: int = max_concurrency, network: str = network_key) -> dict:
+    """ Plans the requested metrics, runs the planned requests concurrently and reshapes the responses
+        :param metrics: Names of the metrics, as defined in planned_metrics
+        :param concurrency: Maximum number of requests that run at the same time
+        :param network: Key of the GBIF network
+        :return results: A dict of each metric and its reshaped result
+    """
+
+    planned_requests = list(plan_queries(metrics, network).values())
+    responses = asyncio.run(fan_out(run_planned_request, planned_requests, concurrency))
+
+    results: dict = {}
+
+    for planned_request, response in zip(planned_requests, responses):
+        for metric in planned_request['metrics']:
+            results[metric] = planned_metrics[metric]['reshape'](response)
+
+    return results
+
+
+def run_planned_request(planned_request: dict) -> dict:
+    """ Internal function of run_queries()
+        :return: The typed response of a single planned request
+    """
+
+    return http_client.get_decoded(planned_request['endpoint'], planned_request['query'], planned_request['decode'])
+
+
+def list_issues() -> list:
+    """ Reads the names of all GBIF issues and flags, used as breakdown filter
+        :return issues: A list of the issue and flag names, as known by the GBIF API
+    """
+
+    issues = []
+
+    with open(issues_file, 'r', newline='', encoding='utf-8') as file:
         reader = csv.reader(file)
         next(reader)
 
         for row in reader:
-            for publisher in publishers:
-                if publisher in row:
-                    publishers[publisher]['name'] = row[4]
-                    publishers[publisher]['ror_id'] = row[5]
-
-    # Calculate metrics for basis of record per publisher and issues/flags
-    basis_of_record = ['PRESERVED_SPECIMEN', 'FOSSIL_SPECIMEN', 'LIVING_SPECIMEN', 'MATERIAL_SAMPLE']
-    b_query: dict = base_query | {
+            issues.append(row[1])
+
+    return issues
+
+
+def issue_display_name(issue: str) -> str:
+    """ Converts the GBIF issue name to the display name used by the breakdown and the csv files
+        :return: The display name of the issue
+    """
+
+    return issue.lower().replace('_', ' ').capitalize()
+
+
+def datasets_per_country_query(network: str) -> tuple:
+    return gbif_dataset, {
+        'network_key': network,
+        'limit': 0,
+        'facet': 'PUBLISHING_COUNTRY',
+        'facetLimit': 1000
+    }
+
+
+def specimens_per_country_query(network: str) -> tuple:
+    return gbif_specimen, network_query(network) | {
+        'basis_of_record': basis_of_record,
+        'advanced': True,
+        'dimension': 'publishing_country',
+        'secondDimension': 'basis_of_record'
+    }
+
+
+def publishing_countries_query(network: str) -> tuple:
+    return gbif_specimen, network_query(network) | {
+        'advanced': True,
+        'dimension': 'publishing_country'
+    }
+
+
+def issues_per_country_query(network: str) -> tuple:
+    return gbif_specimen, network_query(network) | {
+        'issue': list_issues(),
+        'advanced': True,
+        'dimension': 'publishing_country',
+        'secondDimension': 'issue'
+    }
+
+
+def basis_of_record_per_publisher_query(network: str) -> tuple:
+    return gbif_specimen, network_query(network) | {
         'basis_of_record': basis_of_record,
         'advanced': True,
         'dimension': 'publishingOrg',
         'secondDimension': 'basis_of_record'
     }
-    response = requests.get(gbif_specimen, params=b_query).json()
 
-    for publisher in response['results']:
+
+def issues_per_publisher_query(network: str) -> tuple:
+    return gbif_specimen, network_query(network) | {
+        'issue': list_issues(),
+        'advanced': True,
+        'dimension': 'publishingOrg',
+        'secondDimension': 'issue'
+    }
+
+
+def reshape_datasets_per_country(facets: response_models.FacetCounts) -> dict:
+    """ Reshapes the faceted dataset search to the total datasets dict
+        :return total_datasets: A dict of the total and the totals per country
+    """
+
+    return {
+        'total': facets.count,
+        'countries': dict(facets.counts)
+    }
+
+
+def reshape_specimens_per_country(rows: list) -> dict:
+    """ Reshapes the country by basis of record breakdown to the total specimens dict
+        :return total_specimens: A dict of the totals and the totals per country
+    """
+
+    total_specimens: dict = {
+        'total': {},
+        'countries': {}
+    }
+
+    # Iterate through the countries to calculate the total amount of specimens
+    for country in rows:
+        total_specimens['countries'][country.key] = {
+            'total': country.count
+        }
+
+        # Group the totals of countries by basis of record
         i = 0
+        for bor in basis_of_record:
+            if total_specimens['total'].get(bor) is None:
+                total_specimens['total'][bor] = country.values[i]
+            else:
+                total_specimens['total'][bor] += country.values[i]
 
-        # Basis of record
-        for boc in basis_of_record:
-            publishers[publisher['filter']['publishing_org']]['totals'][boc] = publisher['values'][i]
+            total_specimens['countries'][country.key][bor] = country.values[i]
             i += 1
 
-        # While looping for publisher, find issues and flags
-        c_query: dict = base_query | {
-            'publishingOrg': publisher['filter']['publishing_org'],
-            'advanced': True,
-            'dimension': 'issue',
-            'secondDimension': 'month'
+    return total_specimens
+
+
+def reshape_publishing_countries(rows: list) -> list:
+    """ Reshapes the country breakdown to a list of the publishing countries
+        :return: A list of country codes
+    """
+
+    return [country.key for country in rows]
+
+
+def reshape_issues_per_country(rows: list) -> dict:
+    """ Reshapes the country by issue breakdown to the issues and flags dict
+        The monthly progress is left empty, as it is not part of this breakdown
+        :return issues_and_flags: A dict of the totals per country
+    """
+
+    issues_and_flags: dict = {
+        'total': 0, 'countries': {}
+    }
+    issues = list_issues()
+
+    for country in rows:
+        issues_and_flags['countries'][country.key] = {
+            'total': 0
         }
-        response = requests.get(gbif_specimen, params=c_query).json()
 
-        # Set issues and flags values
-        publishers[publisher['filter']['publishing_org']]['issues_and_flags'] = {}
+        for issue, count in zip(issues, country.values):
+            if not count:
+                continue
 
-        for issue_flag in response['results']:
+            issues_and_flags['countries'][country.key][issue_display_name(issue)] = {
+                'total': count,
+                'monthly_progress': {}
+            }
 
-            publishers[publisher['filter']['publishing_org']]['issues_and_flags'][issue_flag['displayName']] \
-                = {'total': issue_flag['count'], 'monthly_progress': []}
+            issues_and_flags['countries'][country.key]['total'] += count
+            issues_and_flags['total'] += count
 
-            for i in range(12):
-                publishers[publisher['filter']['publishing_org']]['issues_and_flags'][issue_flag['displayName']]['monthly_progress'].append(issue_flag['values'][i])
+    return issues_and_flags
 
-    return publishers
+
+def reshape_basis_of_record_per_publisher(rows: list) -> dict:
+    """ Reshapes the publisher by basis of record breakdown
+        :return: A dict of the basis of record totals per publisher
+    """
+
+    return {publisher.key: dict(zip(basis_of_record, publisher.values)) for publisher in rows}
+
+
+def reshape_issues_per_publisher(rows: list) -> dict:
+    """ Reshapes the publisher by issue breakdown
+        The monthly progress is left empty, as it is not part of this breakdown
+        :return: A dict of the issues and flags per publisher
+    """
+
+    issues_and_flags: dict = {}
+    issues = list_issues()
+
+    for publisher in rows:
+        issues_and_flags[publisher.key] = {
+            issue_display_name(issue): {'total': count, 'monthly_progress': []}
+            for issue, count in zip(issues, publisher.values) if count
+        }
+
+    return issues_and_flags
+
+
+# Breakdown rows are identified by the filter of their first dimension
+decode_country_breakdown = partial(response_models.decode_breakdown, filter_field='publishing_country')
+decode_publisher_breakdown = partial(response_models.decode_breakdown, filter_field='publishing_org')
+
+planned_metrics = {
+    'datasets_per_country': {
+        'query': datasets_per_country_query,
+        'decode': response_models.decode_facet_counts,
+        'reshape': reshape_datasets_per_country
+    },
+    'specimens_per_country': {
+        'query': specimens_per_country_query,
+        'decode': decode_country_breakdown,
+        'reshape': reshape_specimens_per_country
+    },
+    'publishing_countries': {
+        'query': publishing_countries_query,
+        'decode': decode_country_breakdown,
+        'reshape': reshape_publishing_countries
+    },
+    'issues_per_country': {
+        'query': issues_per_country_query,
+        'decode': decode_country_breakdown,
+        'reshape': reshape_issues_per_country
+    },
+    'basis_of_record_per_publisher': {
+        'query': basis_of_record_per_publisher_query,
+        'decode': decode_publisher_breakdown,
+        'reshape': reshape_basis_of_record_per_publisher
+    },
+    'issues_per_publisher': {
+        'query': issues_per_publisher_query,
+        'decode': decode_publisher_breakdown,
+        'reshape': reshape_issues_per_publisher
+    }
+}
@@ -1,9 +1,33 @@
-import requests
+import contextvars
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
+# Internal functions
+import checkpoints
+import deadlines
+import harvest_metrics
+import http_client
+import response_models
+import run_results
 
-geocase_endpoint = "https://geocase.eu/api"
 
+# Defining GeoCASe endpoint, can be pointed elsewhere (e.g. the stand-in server)
+geocase_endpoint = os.environ.get('GEOCASE_API_URL', "https://geocase.eu/api")
 
+# Record paging, cursor marks need a sort on the unique key of the records
+record_page_size = 1000
+record_unique_key = os.environ.get('GEOCASE_UNIQUE_KEY', 'id')
+
+
+# Record basis values counted per country and provider, 'Other' is stored as 'Other_geological'
+record_basis = ['Fossil', 'Meteorite', 'Mineral', 'Rock', 'Other']
+
+
+@run_results.memoized()
+@deadlines.budgeted
+@checkpoints.checkpointed('geocase_data')
+@harvest_metrics.harvester
 def gather_data() -> dict:
     """ Questions the GeoCASe API
         Collects data about total specimens and record basis per country
@@ -17,69 +41,27 @@ def gather_data() -> dict:
         'countries': {}
     }
 
-    # Search for all specimens in GeoCASe, facet on provider country
-    query: dict = {
-        'q': '*',
-        'rows': 0,
-        'facet.field': [
-            'providercountry'
-        ],
-        'facet': 'on'
-    }
-    response = requests.get(geocase_endpoint, params=query).json()
+    # Search for all specimens in GeoCASe, pivot provider country on record basis
+    num_found, provider_countries = query_record_basis_pivot('providercountry')
 
     # Set total amount of specimens
-    geocase_data['total']['specimens'] = response['response']['numFound']
-
-    # Set total amount of specimens per provider country
-    provider_countries = response['facet_counts']['facet_fields']['providercountry']
-    country_names = [provider_countries[i] for i in range(0, len(provider_countries), 2)]
-    record_basis = ['Fossil', 'Meteorite', 'Mineral', 'Rock', 'Other']
+    geocase_data['total']['specimens'] = num_found
 
     # Iterate through provider countries
-    i = 0
-    for provider_country in range(1, len(provider_countries), 2):
-        country_name = country_names[i]
-
+    for country_name, country_counts in provider_countries.items():
         geocase_data['countries'][country_name] = {
-            'total': provider_countries[provider_country]
-        }
-
-        # Query API by provider country and facet on basis of record
-        query = {
-            'q': '*',
-            'fq': '{!tag=providercountry}providercountry:(\"' + country_name + '\")',
-            'rows': 0,
-            'facet.field': [
-                'recordbasis'
-            ],
-            'facet': 'on'
+            'total': country_counts.count
         }
-        response = requests.get(geocase_endpoint, params=query).json()
-        provider_record_basis = response['facet_counts']['facet_fields']['recordbasis']
-
-        # Set record basis values
-        for rb in record_basis:
-            rb_amount = provider_record_basis[provider_record_basis.index(rb) + 1]
-
-            # Check if record basis is other
-            if rb == 'Other':
-                rb = 'Other_geological'
-
-            geocase_data['countries'][country_name][rb] = rb_amount
-
-            # Add to record basis total
-            if not geocase_data['total'].get(rb):
-                geocase_data['total'][rb] = rb_amount
-            else:
-                geocase_data['total'][rb] += rb_amount
 
-        # Plus one for the overlapping loop
-        i += 1
+        add_record_basis(geocase_data['countries'][country_name], geocase_data['total'], country_counts.counts)
 
     return geocase_data
 
 
+@run_results.memoized()
+@deadlines.budgeted
+@checkpoints.checkpointed('geocase_publishers')
+@harvest_metrics.harvester
 def gather_publishers() -> dict:
     """ Questions the GeoCASe API
         Collects data about total specimens and record basis per publisher (provider)
@@ -93,75 +75,175 @@ def gather_publishers() -> dict:
         'providers': {}
     }
 
-    # Search for all specimens in GeoCASe, facet on publisher
-    query: dict = {
-        'q': '*',
-        'rows': 0,
-        'facet.field': [
-            'providername'
-        ],
-        'facet': 'on'
-    }
-    response = requests.get(geocase_endpoint, params=query).json()
+    # Search for all specimens in GeoCASe, pivot publisher on record basis
+    num_found, providers = query_record_basis_pivot('providername')
 
     # Set total amount of specimens
-    publishers['total']['specimens'] = response['response']['numFound']
-
-    # Set total amount of specimens per provider
-    providers = response['facet_counts']['facet_fields']['providername']
-    provider_names = [providers[i] for i in range(0, len(providers), 2)]
-    record_basis = ['Fossil', 'Meteorite', 'Mineral', 'Rock', 'Other']
+    publishers['total']['specimens'] = num_found
 
     # Iterate through providers
-    i = 0
-    for provider in range(1, len(providers), 2):
-        provider_name = provider_names[i]
-
+    for provider_name, provider_counts in providers.items():
         publishers['providers'][provider_name] = {
-            'total': providers[provider]
+            'total': provider_counts.count
         }
 
-        # Query API by provider and facet on record basis
-        publishers = query_on_record_basis(provider_name, publishers, record_basis)
-
-        # Plus one for the overlapping loop
-        i += 1
+        add_record_basis(publishers['providers'][provider_name], publishers['total'], provider_counts.counts)
 
     return publishers
 
 
-def query_on_record_basis(provider_name: str, publishers: dict, record_basis: list) -> dict:
-    """ Internal function of gather_publishers()
-        Request record basis data from GeoCASe API per individual provider
-        :return: Returns the updated publishers dict
+def query_record_basis_pivot(field: str) -> tuple:
+    """ Internal function of gather_data() and gather_publishers()
+        Requests the record basis counts of every value of the field at once with a Solr facet pivot,
+        so the number of requests does not grow with the number of countries or providers
+        :param field: The field to pivot on record basis, like providercountry
+        :return: Tuple of the total amount of specimens and a dict of the counts per value of the field
     """
 
     query: dict = {
         'q': '*',
-        'fq': '{!tag=providername}providername:(\"' + provider_name + '\")',
         'rows': 0,
-        'facet.field': [
-            'recordbasis'
+        'facet.pivot': [
+            f'{field},recordbasis'
         ],
+        'facet.limit': -1,
         'facet': 'on'
     }
-    response = requests.get(geocase_endpoint, params=query).json()
-    provider_record_basis = response['facet_counts']['facet_fields']['recordbasis']
+    response = http_client.get_decoded(geocase_endpoint, query, response_models.decode_solr_pivots)
+
+    return response.num_found, response.pivots[f'{field},recordbasis']
+
+
+def add_record_basis(counts: dict, total: dict, pivot_record_basis: dict):
+    """ Internal function of gather_data() and gather_publishers()
+        Sets the record basis values of a country or provider and adds them to the totals
+    """
 
-    # Set record basis values
     for rb in record_basis:
-        rb_amount = provider_record_basis[provider_record_basis.index(rb) + 1]
+        rb_amount = pivot_record_basis.get(rb, 0)
 
         # Check if record basis is other
         if rb == 'Other':
             rb = 'Other_geological'
 
-        publishers['providers'][provider_name][rb] = rb_amount
+        counts[rb] = rb_amount
 
         # Add to record basis total
-        if not publishers['total'].get(rb):
-            publishers['total'][rb] = rb_amount
+        if not total.get(rb):
+            total[rb] = rb_amount
         else:
-            publishers['total'][rb] += rb_amount
+            total[rb] += rb_amount
+
+
+@deadlines.budgeted
+@harvest_metrics.harvester
+def gather_record_statistics(aggregators: dict, fields: list, filters: list = None) -> dict:
+    """ Questions the GeoCASe API record by record
+        Streams all records through the aggregators in one pass, so any breakdown of the record fields can be counted
+        without a query of its own, e.g. {'collections': count_by('providername', 'collectioncode')}
+        :param aggregators: Dict of the name of each statistic to the function giving the key a record is counted under
+        :param fields: The record fields the aggregators use
+        :param filters: Solr filter queries selecting the records
+        :return: Returns a dict of the total amount of records and the counts per key of each statistic
+    """
 
-    return publishers
+    return aggregate_records(iterate_records(fields, filters), aggregators)
+
+
+def iterate_records(fields: list, filters: list = None, page_size: int = record_page_size):
+    """ Generator that pages through the GeoCASe records with a Solr cursor mark
+        The next page is requested while the records of the current one are handled
+        :param fields: The record fields to request
+        :param filters: Solr filter queries selecting the records
+        :param page_size: Number of records per request
+        :return: Yields the records one at a time, as dicts of the requested fields
+    """
+
+    query: dict = {
+        'q': '*',
+        'fq': filters or [],
+        'fl': ','.join(fields),
+        'rows': page_size,
+        'sort': f'{record_unique_key} asc'
+    }
+    cursor_mark = '*'
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = get_record_page(query, cursor_mark)
+
+        while True:
+            # The cursor mark stays the same once all records have been returned
+            done = not page.docs or page.next_cursor_mark in (None, cursor_mark)
+
+            if not done:
+                cursor_mark = page.next_cursor_mark
+                pending = executor.submit(contextvars.copy_context().run, get_record_page, query, cursor_mark)
+
+            yield from page.docs
+
+            if done:
+                break
+
+            page = pending.result()
+
+
+def get_record_page(query: dict, cursor_mark: str) -> response_models.SolrPage:
+    """ Internal function of iterate_records(), requests a single page of records
+        Pages are used once, so they bypass the response cache and are not shared with identical requests of the run
+        :return: The page of records
+    """
+
+    params = query | {'cursorMark': cursor_mark}
+    return response_models.decode_solr_page(http_client.get_body(geocase_endpoint, params, cache=False))
+
+
+def aggregate_records(records, aggregators: dict) -> dict:
+    """ Counts a stream of records per key of each aggregator, keeping only the counts and not the records
+        :param records: Iterable of record dicts
+        :param aggregators: Dict of the name of each statistic to the function giving the key a record is counted under,
+            records for which it returns None are not counted
+        :return: A dict of the total amount of records and the counts per key of each statistic
+    """
+
+    total = 0
+    counts = {name: Counter() for name in aggregators}
+
+    for record in records:
+        total += 1
+
+        for name, key_of in aggregators.items():
+            key = key_of(record)
+
+            if key is not None:
+                counts[name][key] += 1
+
+    return {'total': total} | {name: dict(counter) for name, counter in counts.items()}
+
+
+def count_by(*fields: str):
+    """ Builds an aggregator counting records per value of the fields, multi-valued fields by their tuple of values
+        :return: Function giving the key of a record, a single value or a tuple of values
+    """
+
+    def key_of(record: dict):
+        values = tuple(tuple(value) if isinstance(value, list) else value for value in map(record.get, fields))
+
+        return values[0] if len(values) == 1 else values
+
+    return key_of
+
+
+def count_by_year(field: str):
+    """ Builds an aggregator counting records per year of a date field, like the date a record was entered
+        :return: Function giving the year of a record, or None when the record has no such date
+    """
+
+    def key_of(record: dict):
+        value = record.get(field)
+
+        if isinstance(value, list):
+            value = value[0] if value else None
+
+        return int(value[:4]) if isinstance(value, str) and value[:4].isdigit() else None
+
+    return key_of
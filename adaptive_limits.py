@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+
+
+# Starting and minimum number of requests in flight per host, the maximum is the host's connection pool size
+initial_limit = int(os.environ.get('HARVEST_INITIAL_CONCURRENCY', 4))
+minimum_limit = 1
+
+# Additive increase: the limit grows by one after a full limit of requests succeeded without trouble
+# Multiplicative decrease: on rate limiting or overload (429, 503) the limit is halved,
+# on latency far above the usual latency it is lowered gently
+overload_statuses = {429, 503}
+overload_decrease = 0.5
+latency_decrease = 0.9
+latency_tolerance = 3.0
+latency_smoothing = 0.1
+
+limits: dict = {}
+limits_lock = threading.Lock()
+
+
+class AdaptiveLimit:
+    """ Number of requests to a single host that may be in flight, adjusted to what the host sustains
+    """
+
+    def __init__(self, host: str, maximum: int):
+        self.host = host
+        self.maximum = maximum
+        self.limit = float(min(initial_limit, maximum))
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.average_latency = None
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout: float = None) -> bool:
+        """ Waits until a request to the host may be sent
+            :param timeout: Most seconds to wait, waits as long as needed when None
+            :return: Whether a slot was acquired within the timeout
+        """
+
+        end = None if timeout is None else time.monotonic() + timeout
+
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                pause = self.paused_until - now
+                left = None if end is None else end - now
+
+                if (pause > 0 or self.in_flight >= int(self.limit)) and left is not None and left <= 0:
+                    return False
+
+                if pause > 0:
+                    self.condition.wait(pause if left is None else min(pause, left))
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait(left)
+                else:
+                    break
+
+            self.in_flight += 1
+
+        return True
+
+    def acquire_extra(self) -> bool:
+        """ Takes a slot beyond the limit for the duplicate of a slow request, unless the host asked to wait
+            The share of hedged requests is bounded by the http client
+            :return: Whether the slot was taken
+        """
+
+        with self.condition:
+            if self.paused_until > time.monotonic():
+                return False
+
+            self.in_flight += 1
+
+        return True
+
+    def cancel(self):
+        """ Frees the slot of a request that was never sent, without adjusting the limit
+        """
+
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def release(self, status, seconds: float, retry_after: float = None):
+        """ Frees the slot of a finished request and adjusts the limit to how the host responded
+            :param status: The status code, or 'error' when no response was received
+            :param seconds: Time until the response was received
+            :param retry_after: Seconds the host asked to wait, if any
+        """
+
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            if retry_after:
+                # The host asked all requests to wait, not just this one
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+            if status in overload_statuses or status == 'error':
+                self.decrease(overload_decrease, now)
+            elif self.average_latency is not None and seconds > self.average_latency * latency_tolerance:
+                self.decrease(latency_decrease, now)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            # Slow outliers do not move the usual latency as much
+            if self.average_latency is None:
+                self.average_latency = seconds
+            else:
+                self.average_latency += latency_smoothing * (min(seconds, self.average_latency * latency_tolerance)
+                                                             - self.average_latency)
+
+            self.condition.notify_all()
+
+    def decrease(self, factor: float, now: float):
+        """ Internal function of release(), lowers the limit at most once per usual latency
+            so a burst of failures of requests that were already in flight counts as one signal
+        """
+
+        if now - self.last_decrease < (self.average_latency or 0):
+            return
+
+        self.limit = max(minimum_limit, self.limit * factor)
+        self.last_decrease = now
+
+
+def for_host(host: str, maximum: int) -> AdaptiveLimit:
+    """ Finds the limit of a host, shared by all requests to that host within the process
+        :param maximum: Highest limit, the size of the host's connection pool
+        :return: The adaptive limit of the host
+    """
+
+    with limits_lock:
+        if host not in limits:
+            limits[host] = AdaptiveLimit(host, maximum)
+
+        return limits[host]
@@ -0,0 +1,101 @@
+import argparse
+import json
+import logging
+import os
+import time
+import tracemalloc
+from urllib.parse import urlsplit
+
+import response_models
+from benchmarks import standin_server
+
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+
+def decoder_for(key: str):
+    """ Picks the typed decoder of a recorded request
+        :return: The decode function, or None for payloads the harvest does not decode
+    """
+
+    path = urlsplit(key).path
+
+    if path.endswith('/dataset/search') and 'facet=' in key:
+        return response_models.decode_facet_counts
+    if path.endswith('/dataset/search') or path.endswith('/constituents'):
+        return response_models.decode_dataset_page
+    if path.endswith('/occurrence/breakdown'):
+        return response_models.decode_breakdown
+    if path in ('/api', '/api/') and 'facet.pivot=' in key:
+        return response_models.decode_solr_pivots
+    if path in ('/api', '/api/'):
+        return response_models.decode_solr_facets
+
+    return None
+
+
+def measure(function, body: str, repeat: int) -> tuple:
+    """ Times the decoding of a payload and measures the memory its result keeps alive
+        :return: Tuple of the best time in seconds and the retained bytes
+    """
+
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(body)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = function(body)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+
+    return best, retained
+
+
+def run_benchmark(repeat: int) -> dict:
+    """ Compares the generic json.loads path with the typed decoding on all recorded payloads
+        :return totals: Dict of the endpoint to the summed times and retained bytes of both paths
+    """
+
+    totals: dict = {}
+
+    for file_name in sorted(os.listdir(standin_server.fixtures_directory)):
+        with open(os.path.join(standin_server.fixtures_directory, file_name), 'r', encoding='utf-8') as file:
+            fixture = json.load(file)
+
+        decode = decoder_for(fixture['key'])
+
+        if decode is None:
+            continue
+
+        generic = measure(json.loads, fixture['body'], repeat)
+        typed = measure(decode, fixture['body'], repeat)
+
+        endpoint = urlsplit(fixture['key']).path
+        totals.setdefault(endpoint, {'payloads': 0, 'generic': [0, 0], 'typed': [0, 0]})
+        totals[endpoint]['payloads'] += 1
+
+        for path, (seconds, retained) in (('generic', generic), ('typed', typed)):
+            totals[endpoint][path][0] += seconds
+            totals[endpoint][path][1] += retained
+
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark typed decoding against json.loads on recorded payloads')
+    parser.add_argument('--repeat', type=int, default=20)
+    arguments = parser.parse_args()
+
+    if not os.path.isdir(standin_server.fixtures_directory):
+        raise SystemExit('No recorded payloads, record them first with: python -m benchmarks.benchmark_harvest --mode record')
+
+    for endpoint, total in run_benchmark(arguments.repeat).items():
+        logging.info(
+            f'{endpoint} ({total["payloads"]} payloads): '
+            f'json.loads {total["generic"][0] * 1000:.1f}ms, {total["generic"][1] / 1024:.0f}KiB retained; '
+            f'typed {total["typed"][0] * 1000:.1f}ms, {total["typed"][1] / 1024:.0f}KiB retained'
+        )
@@ -0,0 +1,79 @@
+import argparse
+import logging
+import os
+import time
+
+from benchmarks import standin_server
+
+
+def run_benchmark(targets: list, repeat: int, database: bool) -> dict:
+    """ Runs the harvest jobs against the stand-in server and times them
+        The stand-in must be running and the base urls set before calling this
+        :param targets: Jobs to run, 'execute_all' and/or 'main2'
+        :param repeat: Number of runs per job
+        :param database: Whether main2 writes to the database, otherwise the inserts are skipped
+        :return timings: Dict of the job and its run times in seconds
+    """
+
+    # Imported here, as the harvest modules read the base urls on import
+    import csv_functions
+    import http_client
+    import main
+    import main2
+    import query_database
+    import run_results
+
+    os.makedirs(f'csv_files/storage/{csv_functions.current_month}', exist_ok=True)
+
+    if not database:
+        query_database.insert_countries_data = lambda *data: None
+        query_database.insert_organisations_data = lambda *data: None
+
+    jobs = {
+        'execute_all': main.execute_all,
+        'main2': main2.main2
+    }
+    timings: dict = {}
+
+    for target in targets:
+        timings[target] = []
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            jobs[target]()
+            timings[target].append(time.perf_counter() - start)
+
+            # Every run harvests anew, as separate runs do
+            run_results.forget()
+            http_client.forget_coalesced()
+
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the harvest against the local stand-in APIs')
+    parser.add_argument('targets', nargs='*', default=['execute_all', 'main2'], choices=['execute_all', 'main2'])
+    parser.add_argument('--mode', choices=['record', 'replay'], default='replay')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--database', action='store_true', help='Let main2 write to the configured database')
+    arguments = parser.parse_args()
+
+    ports = standin_server.serve_upstreams(mode=arguments.mode, latency=arguments.latency, jitter=arguments.jitter,
+                                           error_rate=arguments.error_rate)
+    os.environ.update(standin_server.base_urls(ports))
+    standin_server.register_hosts(os.environ)
+
+    # Measure the harvest itself, not the response cache
+    os.environ['HARVEST_CACHE'] = 'off'
+
+    results = run_benchmark(arguments.targets, arguments.repeat, arguments.database)
+    logging.getLogger().setLevel(logging.INFO)
+
+    for job, job_timings in results.items():
+        logging.info(f'{job}: best {min(job_timings):.2f}s, mean {sum(job_timings) / len(job_timings):.2f}s '
+                     f'over {len(job_timings)} runs')
+
+    logging.info(f'Stand-in: {standin_server.statistics}')
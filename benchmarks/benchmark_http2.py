@@ -0,0 +1,96 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from urllib.parse import urlsplit
+
+from benchmarks import standin_server
+
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+
+def time_issues_flags(environment: dict, repeat: int, concurrency: int, pool_size: int) -> dict:
+    """ Times the per country issues and flags fan-out of gather_issues_flags() in a fresh process
+        :param environment: Environment variables pointing the harvest to a stand-in and choosing the transport
+        :param pool_size: HTTP/1.1 connections kept alive to the stand-in, as for the GBIF hosts
+        :return: Dict of the run times in seconds and the HTTP versions the stand-in was spoken to with
+    """
+
+    os.environ.update(environment)
+
+    # Imported here, as the harvest modules read the base urls and transport on import
+    import GBIF_functions
+    import http_client
+
+    # The pool of the stand-in is mounted by its network location, port included
+    http_client.host_pool_sizes[urlsplit(environment['GBIF_API_URL']).netloc] = pool_size
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        GBIF_functions.gather_issues_flags(concurrency=concurrency)
+        timings.append(time.perf_counter() - start)
+
+        # Every run requests everything again
+        http_client.forget_coalesced()
+
+    return {
+        'timings': timings,
+        'http2_hosts': sorted(http_client.http2_hosts),
+        'http1_hosts': sorted(http_client.http1_hosts)
+    }
+
+
+def run_benchmark(ports: dict, repeat: int, concurrency: int, pool_size: int) -> dict:
+    """ Runs the issues and flags fan-out over HTTP/1.1 and over HTTP/2, each in its own process
+        :param ports: Dict of the transport to the port of the stand-in speaking it
+        :return results: Dict of the transport to its timings
+    """
+
+    results: dict = {}
+
+    for transport, http2 in (('HTTP/1.1', 'off'), ('HTTP/2', 'prior-knowledge')):
+        # The fan-out only requests the GBIF API, so every upstream is pointed to the one stand-in of the transport
+        environment = standin_server.base_urls(dict.fromkeys(standin_server.upstream_urls, ports[transport])) | {
+            'HARVEST_HTTP2': http2,
+            'HARVEST_CACHE': 'off',
+            'HARVEST_HEDGE': 'off'
+        }
+
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            results[transport] = executor.submit(time_issues_flags, environment, repeat, concurrency,
+                                                 pool_size).result()
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark HTTP/1.1 pooling against HTTP/2 for the issues and flags fan-out on the stand-in'
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=64, help='Countries requested at the same time')
+    parser.add_argument('--pool-size', type=int, default=16, help='HTTP/1.1 connections to the stand-in')
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--jitter', type=float, default=0.1)
+    arguments = parser.parse_args()
+
+    if not os.path.isdir(standin_server.fixtures_directory):
+        raise SystemExit('No recorded payloads, record them first with: python -m benchmarks.benchmark_harvest --mode record')
+
+    options = {'mode': 'replay', 'latency': arguments.latency, 'jitter': arguments.jitter}
+    http1_server = standin_server.serve(0, background=True, **options)
+    http2_port = standin_server.serve_http2(0, background=True, **options)
+
+    results = run_benchmark({'HTTP/1.1': http1_server.server_port, 'HTTP/2': http2_port}, arguments.repeat,
+                            arguments.concurrency, arguments.pool_size)
+
+    for transport, result in results.items():
+        logging.info(f'{transport}: best {min(result["timings"]):.2f}s, '
+                     f'mean {sum(result["timings"]) / len(result["timings"]):.2f}s over {len(result["timings"])} runs '
+                     f'(HTTP/2 hosts: {result["http2_hosts"] or "none"})')
+
+    logging.info(f'Stand-in: {standin_server.statistics}')
@@ -0,0 +1,110 @@
+import argparse
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from benchmarks import standin_server
+
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+
+def run_shard(environment: dict, index: int, count: int, database: bool) -> dict:
+    """ Runs one shard of main2 in a fresh process, as a pod of the Indexed Job would
+        :param environment: Environment variables pointing the harvest to a stand-in and the shared shard directory
+        :param index: Index of the shard, shard 0 merges all shards and runs the inserts
+        :param count: Number of shards, 1 runs main2 unsharded
+        :param database: Whether to write to the configured database, otherwise the inserts are recorded
+        :return: Dict of the run time in seconds and the recorded inserts
+    """
+
+    os.environ.update(environment)
+
+    # Imported here, as the harvest modules read the base urls on import
+    import main2
+    import query_database
+
+    standin_server.register_hosts(environment)
+    inserts = []
+
+    if not database:
+        query_database.insert_countries_data = lambda *data: inserts.append(('countries', data))
+        query_database.insert_organisations_data = lambda *data: inserts.append(('organisations', data))
+
+    start = time.perf_counter()
+
+    if count > 1:
+        main2.main2_shard(index, count)
+    else:
+        main2.main2()
+
+    return {
+        'seconds': time.perf_counter() - start,
+        'inserts': sorted(inserts, key=lambda insert: (insert[0], insert[1][-1]))
+    }
+
+
+def run_benchmark(ports: dict, shards: int, database: bool) -> dict:
+    """ Runs main2 unsharded and split over worker processes against the stand-in
+        :param ports: Dict of the environment variable of each upstream to the port of its stand-in
+        :param shards: Number of worker processes
+        :return results: Dict of the run times and whether the sharded inserts equal the unsharded ones
+    """
+
+    results: dict = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        environment = standin_server.base_urls(ports) | {
+            'HARVEST_CACHE': 'off',
+            'HARVEST_SHARD_DIR': os.path.join(directory, 'shards'),
+            'HARVEST_CHECKPOINT_DIR': os.path.join(directory, 'checkpoints')
+        }
+
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            unsharded = executor.submit(run_shard, environment | {
+                'HARVEST_METRICS_FILE': os.path.join(directory, 'unsharded.prom')
+            }, 0, 1, database).result()
+
+        with ProcessPoolExecutor(max_workers=shards, mp_context=get_context('spawn')) as executor:
+            futures = [
+                executor.submit(run_shard, environment | {
+                    'HARVEST_METRICS_FILE': os.path.join(directory, f'shard-{index}.prom')
+                }, index, shards, database)
+                for index in range(shards)
+            ]
+            sharded = [future.result() for future in futures]
+
+        results['unsharded'] = unsharded['seconds']
+        # The first shard finishes last, it waits for the others and runs the rest of main2
+        results['sharded'] = max(shard['seconds'] for shard in sharded)
+        results['shards'] = [shard['seconds'] for shard in sharded]
+        results['equal'] = database or sharded[0]['inserts'] == unsharded['inserts']
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark main2 split over shards against the local stand-in APIs')
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--database', action='store_true', help='Let main2 write to the configured database')
+    arguments = parser.parse_args()
+
+    if not os.path.isdir(standin_server.fixtures_directory):
+        raise SystemExit('No recorded payloads, record them first with: python -m benchmarks.benchmark_harvest --mode record')
+
+    ports = standin_server.serve_upstreams(mode='replay', latency=arguments.latency, jitter=arguments.jitter)
+    results = run_benchmark(ports, arguments.shards, arguments.database)
+
+    logging.info(f'Unsharded: {results["unsharded"]:.2f}s')
+    logging.info(f'{arguments.shards} shards: {results["sharded"]:.2f}s '
+                 f'({", ".join(f"{seconds:.2f}s" for seconds in results["shards"])})')
+
+    if not arguments.database:
+        logging.info(f'Sharded inserts equal the unsharded inserts: {results["equal"]}')
+
+    logging.info(f'Stand-in: {standin_server.statistics}')
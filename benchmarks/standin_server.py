@@ -0,0 +1,372 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+# HTTP/2 is optional, only needed to serve the stand-in over HTTP/2
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+# Real APIs behind the stand-in paths, the stand-in mirrors their paths:
+# GBIF_API_URL=http://host:port/v1, GBIF_PORTAL_API_URL=http://host:port/api, GEOCASE_API_URL=http://host:port/api
+upstreams = {
+    '/v1/': 'https://api.gbif.org',
+    '/api/occurrence/': 'https://www.gbif.org',
+    '/api': 'https://geocase.eu'
+}
+
+# Base urls of the real APIs by the environment variable the harvest modules read them from
+# Each is stood in for on a port of its own, so the harvest keeps a pool and limit per upstream as in production
+upstream_urls = {
+    'GBIF_API_URL': 'https://api.gbif.org/v1',
+    'GBIF_PORTAL_API_URL': 'https://www.gbif.org/api',
+    'GEOCASE_API_URL': 'https://geocase.eu/api'
+}
+
+fixtures_directory = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# Behaviour of the stand-in, set by serve()
+settings = {
+    'mode': 'replay',
+    'latency': 0.0,
+    'jitter': 0.0,
+    'error_rate': 0.0,
+    'error_status': 503,
+    'retry_after': 0
+}
+
+statistics = {
+    'requests': 0,
+    'injected_errors': 0,
+    'missing_fixtures': 0
+}
+statistics_lock = threading.Lock()
+
+
+def upstream_for(path: str):
+    """ Finds the real API behind a stand-in path, the GeoCASe endpoint only matches exactly
+        :return: The upstream base url, or None for unknown paths
+    """
+
+    for prefix, upstream in upstreams.items():
+        if prefix == '/api' and path in ('/api', '/api/'):
+            return upstream
+        if prefix != '/api' and path.startswith(prefix):
+            return upstream
+
+    return None
+
+
+def fixture_key(path: str, query: str) -> str:
+    """ Canonical form of a request, independent of the parameter order
+        :return: The path with its sorted query parameters
+    """
+
+    return path + '?' + urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+
+
+def fixture_path(key: str) -> str:
+    return os.path.join(fixtures_directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def record(path: str, query: str, key: str) -> dict:
+    """ Fetches the request from the real API and captures the response as fixture
+        :return fixture: Dict of the status, headers and body
+    """
+
+    response = requests.get(upstream_for(path) + path + ('?' + query if query else ''), timeout=(10, 180))
+
+    fixture = {
+        'key': key,
+        'status': response.status_code,
+        'headers': {
+            header: response.headers[header]
+            for header in ('Content-Type', 'ETag', 'Last-Modified') if header in response.headers
+        },
+        'body': response.text
+    }
+
+    if response.ok:
+        os.makedirs(fixtures_directory, exist_ok=True)
+
+        with open(fixture_path(key), 'w', encoding='utf-8') as file:
+            json.dump(fixture, file)
+
+    return fixture
+
+
+def replay(key: str):
+    """ Reads the fixture of a request
+        :return: Dict of the status, headers and body, or None when it was never recorded
+    """
+
+    try:
+        with open(fixture_path(key), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def handle(path: str) -> tuple:
+    """ Answers a request to the stand-in, from its fixture or the real API
+        :param path: The requested path and query
+        :return: Tuple of the status, headers and body
+    """
+
+    request = urlsplit(path)
+
+    with statistics_lock:
+        statistics['requests'] += 1
+
+    if upstream_for(request.path) is None:
+        return 404, {}, json.dumps({'error': f'Unknown endpoint {request.path}'})
+
+    # Simulated network and server latency
+    delay = settings['latency'] + random.uniform(0, settings['jitter'])
+
+    if delay:
+        time.sleep(delay)
+
+    if random.random() < settings['error_rate']:
+        with statistics_lock:
+            statistics['injected_errors'] += 1
+
+        return settings['error_status'], {'Retry-After': str(settings['retry_after'])}, \
+            json.dumps({'error': 'Injected error'})
+
+    key = fixture_key(request.path, request.query)
+
+    if settings['mode'] == 'record':
+        fixture = record(request.path, request.query, key)
+    else:
+        fixture = replay(key)
+
+    if fixture is None:
+        with statistics_lock:
+            statistics['missing_fixtures'] += 1
+
+        logging.warning(f'No fixture recorded for {key}')
+
+        return 404, {}, json.dumps({'error': f'No fixture recorded for {key}'})
+
+    return fixture['status'], fixture['headers'], fixture['body']
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(*handle(self.path))
+
+    def respond(self, status: int, headers: dict, body: str):
+        encoded = body.encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', headers.get('Content-Type', 'application/json'))
+        self.send_header('Content-Length', str(len(encoded)))
+
+        for header, value in headers.items():
+            if header != 'Content-Type':
+                self.send_header(header, value)
+
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int = 8765, background: bool = False, **options) -> ThreadingHTTPServer:
+    """ Starts the stand-in server
+        :param port: Port to listen on, 0 picks a free port
+        :param background: Whether to serve from a daemon thread and return immediately
+        :param options: Overrides of the settings (mode, latency, jitter, error_rate, error_status, retry_after)
+        :return server: The running server, its port is in server.server_port
+    """
+
+    settings.update(options)
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+    server.daemon_threads = True
+
+    logging.info(f'Stand-in serving on port {server.server_port} in {settings["mode"]} mode')
+
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+
+    return server
+
+
+class Http2StandIn(asyncio.Protocol):
+    """ HTTP/2 connection to the stand-in, spoken right away without negotiation (prior knowledge)
+        Every stream is answered from a worker thread, so slow responses do not hold up the other streams
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.connection = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False,
+                                                                               header_encoding='utf-8'))
+        self.pending: dict = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connection.initiate_connection()
+        self.transport.write(self.connection.data_to_send())
+
+    def data_received(self, data: bytes):
+        try:
+            events = self.connection.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.connection.data_to_send())
+            self.transport.close()
+
+            return
+
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                asyncio.ensure_future(self.respond(event.stream_id, dict(event.headers)[':path']))
+            elif isinstance(event, h2.events.StreamReset):
+                self.pending.pop(event.stream_id, None)
+            elif isinstance(event, h2.events.WindowUpdated):
+                self.send_pending()
+
+        self.transport.write(self.connection.data_to_send())
+
+    async def respond(self, stream_id: int, path: str):
+        status, headers, body = await asyncio.get_running_loop().run_in_executor(None, handle, path)
+        encoded = body.encode('utf-8')
+
+        try:
+            self.connection.send_headers(stream_id, [
+                (':status', str(status)),
+                ('content-type', headers.get('Content-Type', 'application/json')),
+                ('content-length', str(len(encoded)))
+            ] + [(header.lower(), value) for header, value in headers.items() if header != 'Content-Type'])
+        except h2.exceptions.StreamClosedError:
+            # The client gave up on the stream in the meantime
+            return
+
+        self.pending[stream_id] = encoded
+        self.send_pending()
+
+    def send_pending(self):
+        """ Sends as much of the pending response bodies as the flow control windows allow
+        """
+
+        for stream_id, data in list(self.pending.items()):
+            while data:
+                window = min(self.connection.local_flow_control_window(stream_id),
+                             self.connection.max_outbound_frame_size)
+
+                if window <= 0:
+                    break
+
+                self.connection.send_data(stream_id, data[:window])
+                data = data[window:]
+
+            if data:
+                self.pending[stream_id] = data
+            else:
+                self.connection.end_stream(stream_id)
+                del self.pending[stream_id]
+
+        self.transport.write(self.connection.data_to_send())
+
+
+def serve_http2(port: int = 8766, background: bool = False, **options) -> int:
+    """ Starts the stand-in server speaking HTTP/2, needs the h2 package
+        :param port: Port to listen on, 0 picks a free port
+        :param background: Whether to serve from a daemon thread and return immediately
+        :param options: Overrides of the settings, as for serve()
+        :return: The port the server listens on
+    """
+
+    if h2 is None:
+        raise RuntimeError('Serving HTTP/2 needs the h2 package: pip install h2')
+
+    settings.update(options)
+    loop = asyncio.new_event_loop()
+    # As many streams in their latency at once as the threaded HTTP/1.1 server would handle
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=128))
+    server = loop.run_until_complete(loop.create_server(Http2StandIn, '127.0.0.1', port))
+    port = server.sockets[0].getsockname()[1]
+
+    logging.info(f'HTTP/2 stand-in serving on port {port} in {settings["mode"]} mode')
+
+    if background:
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+    else:
+        loop.run_forever()
+
+    return port
+
+
+def serve_upstreams(**options) -> dict:
+    """ Starts a background stand-in per upstream, each on a free port
+        :param options: Overrides of the settings, as for serve()
+        :return ports: Dict of the environment variable of each upstream to the port standing in for it
+    """
+
+    return {variable: serve(0, background=True, **options).server_port for variable in upstream_urls}
+
+
+def base_urls(ports: dict) -> dict:
+    """ The environment variables that point the harvest modules to the stand-in
+        Must be set before GBIF_functions and GeoCASe_functions are imported
+        :param ports: Dict of the environment variable of each upstream to the port standing in for it
+        :return: Dict of environment variables
+    """
+
+    return {
+        variable: f'http://127.0.0.1:{ports[variable]}{urlsplit(url).path}' for variable, url in upstream_urls.items()
+    }
+
+
+def register_hosts(environment: dict):
+    """ Gives each stand-in port the connection pool and timeouts of the real host it stands in for
+        Must be called in the process running the harvest, before its first request
+        :param environment: The environment variables from base_urls()
+    """
+
+    import http_client
+
+    for variable, url in upstream_urls.items():
+        host = urlsplit(environment[variable]).netloc
+        real_host = urlsplit(url).netloc
+        http_client.host_pool_sizes[host] = http_client.host_pool_sizes[real_host]
+        http_client.host_timeouts[host] = http_client.host_timeouts[real_host]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the GBIF and GeoCASe APIs')
+    parser.add_argument('--mode', choices=['record', 'replay'], default='replay')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Maximum random seconds added on top')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with an error')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--retry-after', type=int, default=0)
+    parser.add_argument('--http2', action='store_true', help='Speak HTTP/2 with prior knowledge instead of HTTP/1.1')
+    arguments = parser.parse_args()
+
+    (serve_http2 if arguments.http2 else serve)(arguments.port, mode=arguments.mode, latency=arguments.latency, jitter=arguments.jitter,
+          error_rate=arguments.error_rate, error_status=arguments.error_status, retry_after=arguments.retry_after)
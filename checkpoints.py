@@ -0,0 +1,121 @@
+import functools
+import inspect
+import logging
+import os
+import pickle
+import re
+import shutil
+
+
+# Directory of the checkpoints, one sub directory per run
+checkpoint_directory = os.environ.get('HARVEST_CHECKPOINT_DIR', 'checkpoints')
+
+# Id of the running harvest, checkpoints are only written while a run is started
+run_id = os.environ.get('HARVEST_RUN_ID')
+
+
+def start(default_run_id: str, resume: bool = True):
+    """ Starts checkpointing for a harvest run
+        A run with the same id that did not complete is resumed from its checkpoints
+        :param default_run_id: Id of the run, unless HARVEST_RUN_ID is set
+        :param resume: Whether to use the checkpoints of an earlier attempt, otherwise they are removed
+    """
+
+    global run_id
+
+    if run_id is None:
+        run_id = default_run_id
+
+    run_directory = os.path.join(checkpoint_directory, run_id)
+
+    if not resume:
+        shutil.rmtree(run_directory, ignore_errors=True)
+    elif os.path.isdir(run_directory):
+        logging.info(f'Resuming run {run_id} from its checkpoints')
+
+
+def complete():
+    """ Removes the checkpoints of the run once it has completed, so the next run starts fresh
+    """
+
+    global run_id
+
+    if run_id is not None:
+        shutil.rmtree(os.path.join(checkpoint_directory, run_id), ignore_errors=True)
+
+    run_id = None
+
+
+def checkpoint_path(name: str, key: str) -> str:
+    """ Internal function, names the checkpoint file of a stage or unit within the run
+        :return: Path of the checkpoint file
+    """
+
+    return os.path.join(checkpoint_directory, run_id, name, re.sub(r'[^\w.=,-]', '_', key) + '.pickle')
+
+
+def load(name: str, key: str):
+    """ Reads a checkpoint of the running harvest
+        :return: Tuple of whether the checkpoint exists and its data
+    """
+
+    if run_id is None:
+        return False, None
+
+    try:
+        with open(checkpoint_path(name, key), 'rb') as file:
+            return True, pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return False, None
+
+
+def save(name: str, key: str, data):
+    """ Writes a checkpoint of the running harvest, replacing the file at once so a crash never leaves half a checkpoint
+    """
+
+    if run_id is None:
+        return
+
+    path = checkpoint_path(name, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(f'{path}.{os.getpid()}.tmp', 'wb') as file:
+        pickle.dump(data, file)
+
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+
+def checkpointed(name: str, ignore: tuple = ()):
+    """ Decorator that checkpoints the result of a harvest stage or unit, keyed by its arguments
+        Within a started run, a completed call is not repeated but read from its checkpoint
+        :param name: Name of the stage or unit
+        :param ignore: Names of arguments that do not change the result, like the concurrency
+    """
+
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if run_id is None:
+                return function(*args, **kwargs)
+
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            key = ','.join(
+                f'{argument}={value}' for argument, value in arguments.arguments.items() if argument not in ignore
+            ) or 'result'
+
+            found, data = load(name, key)
+
+            if found:
+                return data
+
+            data = function(*args, **kwargs)
+            save(name, key, data)
+
+            return data
+
+        return wrapper
+
+    return decorator
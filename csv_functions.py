@@ -8,9 +8,22 @@ import query_csv
 current_month = dt.now().strftime('%B')
 
 
+def csv_path(name: str, network: str = None) -> str:
+    """ Names a csv file of this month, the files of a GBIF network other than DiSSCo carry its key
+        :param name: Name of the csv file, without extension
+        :param network: Key of the GBIF network, None for DiSSCo
+        :return: Path of the csv file
+    """
+
+    if network:
+        return f'csv_files/storage/{current_month}/{name}_{network}.csv'
+
+    return f'csv_files/storage/{current_month}/{name}.csv'
+
+
 # GBIf functions
 
-def write_datasets_to_csv(total_datasets: dict):
+def write_datasets_to_csv(total_datasets: dict, network: str = None):
     """ Takes the total datasets dict and writes it to csv
         :param total_datasets: Dict of global data variable containing total datasets per country
         :return: Writes a csv
@@ -26,7 +39,7 @@ def write_datasets_to_csv(total_datasets: dict):
         values.append(total_datasets['countries'][country])
 
     # Write to gbif_datasets.csv
-    csv_file = f'csv_files/storage/{current_month}/gbif_datasets.csv'
+    csv_file = csv_path('gbif_datasets', network)
 
     with open(csv_file, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
@@ -36,7 +49,7 @@ def write_datasets_to_csv(total_datasets: dict):
     return csv_file
 
 
-def write_specimens_to_csv(total_specimens: dict):
+def write_specimens_to_csv(total_specimens: dict, network: str = None):
     """ Takes the total specimens dict and writes it to csv
         :param total_specimens: Dict of global data variable containing total specimens per country
         :return: Writes a csv
@@ -71,7 +84,7 @@ def write_specimens_to_csv(total_specimens: dict):
         values[country].insert(1, str(country_total))
 
     # Write to gbif_specimens.csv
-    csv_file = f'csv_files/storage/{current_month}/gbif_specimens.csv'
+    csv_file = csv_path('gbif_specimens', network)
 
     with open(csv_file, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
@@ -84,7 +97,7 @@ def write_specimens_to_csv(total_specimens: dict):
     return csv_file
 
 
-def write_issues_and_flags_to_csv(issues_and_flags: dict) -> str:
+def write_issues_and_flags_to_csv(issues_and_flags: dict, network: str = None) -> str:
     """ Takes the total datasets dict and writes it to csv
         :param issues_and_flags: Dict of global data variable containing total issues and flags per country
         :return: Writes a csv, returns name of csv as a string
@@ -134,7 +147,7 @@ def write_issues_and_flags_to_csv(issues_and_flags: dict) -> str:
         values['Total'].append(issue_totals[issue_total])
 
     # Write to gbif_issues_and_flags.csv
-    csv_file = f'csv_files/storage/{current_month}/gbif_issues_and_flags.csv'
+    csv_file = csv_path('gbif_issues_and_flags', network)
 
     with open(csv_file, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
@@ -147,7 +160,7 @@ def write_issues_and_flags_to_csv(issues_and_flags: dict) -> str:
     return csv_file
 
 
-def write_issues_and_flags_monthly_to_csv(issues_and_flags: dict) -> str:
+def write_issues_and_flags_monthly_to_csv(issues_and_flags: dict, network: str = None) -> str:
     """ Let's the user choose a country code and writes the monthly progress of issues and flags to csv
         :param issues_and_flags: Dict of global data variable containing total issues and flags per country
         :return: Writes a csv, returns name of csv as a string
@@ -215,7 +228,7 @@ def write_issues_and_flags_monthly_to_csv(issues_and_flags: dict) -> str:
         values['Total'].append(month_count[i])
 
     # Write to gbif_issues_and_flags_monthly.csv
-    csv_file = f'csv_files/storage/{current_month}/gbif_issues_and_flags_monthly.csv'
+    csv_file = csv_path('gbif_issues_and_flags_monthly', network)
 
     with open(csv_file, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
@@ -228,7 +241,7 @@ def write_issues_and_flags_monthly_to_csv(issues_and_flags: dict) -> str:
     return csv_file
 
 
-def write_institution_to_csv(publishers: dict) -> str:
+def write_institution_to_csv(publishers: dict, network: str = None) -> str:
     """ Receives data from the institution function in main.py
         Calls on related functions to write the data to csv
         :return: Calls on: write_institution_to_csv_totals and
@@ -238,13 +251,13 @@ def write_institution_to_csv(publishers: dict) -> str:
     # Write csv files
     csv_file = ""
 
-    csv_file += write_institutions_to_csv_totals(publishers)
-    csv_file += 'and: ' + write_institutions_to_csv_issues_and_flags(publishers)
+    csv_file += write_institutions_to_csv_totals(publishers, network)
+    csv_file += 'and: ' + write_institutions_to_csv_issues_and_flags(publishers, network)
 
     return csv_file
 
 
-def write_institutions_to_csv_totals(publishers: dict) -> str:
+def write_institutions_to_csv_totals(publishers: dict, network: str = None) -> str:
     """ Prepares data from publishers dictionary and writes this to csv
         Data handled are: total datasets and basis of record
         :param publishers: Dict of GBIF publishers from DiSSCo network and related data
@@ -276,7 +289,7 @@ def write_institutions_to_csv_totals(publishers: dict) -> str:
             values[publisher['gbif_id']].append(publisher['totals'][bor])
 
     # Write to gbif_publishers.csv
-    csv_file = f"csv_files/storage/{current_month}/gbif_publishers.csv"
+    csv_file = csv_path('gbif_publishers', network)
 
     with open(csv_file, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
@@ -289,7 +302,7 @@ def write_institutions_to_csv_totals(publishers: dict) -> str:
     return csv_file
 
 
-def write_institutions_to_csv_issues_and_flags(publishers: dict) -> str:
+def write_institutions_to_csv_issues_and_flags(publishers: dict, network: str = None) -> str:
     """ Prepares data from publishers dictionary and writes this to csv
         Data handled are: issues and flags (total)
         :param publishers: Dict of GBIF publishers from DiSSCo network and related data
@@ -326,7 +339,7 @@ def write_institutions_to_csv_issues_and_flags(publishers: dict) -> str:
         values[publisher['gbif_id']].insert(2, publisher_issue_flag_total)
 
     # Write to gbif_publishers_issues_flags.csv
-    csv_file = f"csv_files/storage/{current_month}/gbif_publishers_issues_flags.csv"
+    csv_file = csv_path('gbif_publishers_issues_flags', network)
 
     with open(csv_file, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
@@ -366,7 +379,7 @@ def write_geocase_specimens_to_csv(geocase_data: dict) -> str:
         values[country] += [v for v in geocase_data['countries'][country].values()]
 
     # Write to geocase_specimens.csv
-    csv_file = f"csv_files/storage/{current_month}/geocase_specimens.csv"
+    csv_file = csv_path('geocase_specimens')
 
     with open(csv_file, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
@@ -404,7 +417,7 @@ def write_geocase_publishers_to_csv(geocase_publishers: dict) -> str:
         values[country] += [v for v in geocase_publishers['providers'][country].values()]
 
     # Write to geocase_publishers.csv
-    csv_file = f"csv_files/storage/{current_month}/geocase_publishers.csv"
+    csv_file = csv_path('geocase_publishers')
 
     with open(csv_file, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
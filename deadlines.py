@@ -0,0 +1,134 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+
+
+# Seconds a whole harvest run may take, split across its stages; 0 means the run has no deadline
+run_budget = float(os.environ.get('HARVEST_DEADLINE', 6 * 3600)) or None
+
+# Share of the run budget per stage, relative to the other stages of the run that have not started yet
+stage_shares = {
+    'gather_datasets': 1,
+    'gather_specimens': 1,
+    'gather_issues_flags': 3,
+    'gather_institutions': 3,
+    'gather_data': 1,
+    'gather_publishers': 2
+}
+default_share = 1
+
+# Monotonic time at which the running stage has to be done, set by the budgeted decorator
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+# Whether the running stage shares the time left in the run with stages running next to it, set by the pipeline
+concurrent_stage = contextvars.ContextVar('concurrent_stage', default=False)
+
+run_deadline = None
+pending_stages: list = []
+deadlines_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when a request can not be completed within the deadline of its stage
+    """
+
+
+def start(stages: list, budget: float = None):
+    """ Starts the deadline of a harvest run
+        :param stages: Names of the stages the run is going to go through, to split the budget across
+        :param budget: Seconds the run may take, defaults to HARVEST_DEADLINE
+    """
+
+    global run_deadline, pending_stages
+
+    budget = budget or run_budget
+
+    with deadlines_lock:
+        run_deadline = time.monotonic() + budget if budget else None
+        pending_stages = list(stages)
+
+
+def complete():
+    """ Ends the deadline of the run
+    """
+
+    global run_deadline, pending_stages
+
+    with deadlines_lock:
+        run_deadline = None
+        pending_stages = []
+
+
+def stage_deadline(name: str):
+    """ Internal function of budgeted(), hands a starting stage its part of the time left in the run
+        Time a stage does not use is left for the stages after it
+        A stage of a pipeline runs at the same time as the other stages, so it gets the time left in the run
+        :return: Monotonic time the stage has to be done, or None without a run deadline
+    """
+
+    with deadlines_lock:
+        if run_deadline is None:
+            return None
+
+        if name in pending_stages:
+            pending_stages.remove(name)
+
+        if concurrent_stage.get():
+            return run_deadline
+
+        remaining = run_deadline - time.monotonic()
+        share = stage_shares.get(name, default_share)
+        shares = share + sum(stage_shares.get(stage, default_share) for stage in pending_stages)
+
+        return time.monotonic() + max(0.0, remaining) * share / shares
+
+
+def budgeted(function):
+    """ Decorator that gives a harvest stage its part of the run deadline, also within its worker threads
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        deadline = stage_deadline(function.__name__)
+        outer = current_deadline.get()
+
+        if outer is not None and (deadline is None or outer < deadline):
+            deadline = outer
+
+        token = current_deadline.set(deadline)
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current_deadline.reset(token)
+
+    return wrapper
+
+
+def remaining():
+    """ Calculates the time left for the running stage
+        :return: Number of seconds, or None when the stage has no deadline
+    """
+
+    deadline = current_deadline.get()
+
+    if deadline is None:
+        return None
+
+    return deadline - time.monotonic()
+
+
+def check(description: str):
+    """ Fails fast once the deadline of the running stage has passed
+        :param description: What was about to happen, for the error message
+        :return: Number of seconds left, or None when the stage has no deadline
+    """
+
+    left = remaining()
+
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f'Stage deadline passed before {description}')
+
+    return left
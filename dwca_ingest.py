@@ -0,0 +1,273 @@
+import logging
+import os
+import xml.etree.ElementTree as ElementTree
+import zipfile
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+# Internal functions
+import checkpoints
+import GBIF_functions
+import run_results
+
+
+# Bytes of the occurrence table handed to a worker process at once, cut at a line end
+# At most max_chunks_in_flight chunks are read ahead, bounding memory whatever the number of CPUs
+chunk_size = 4 * 1024 * 1024
+max_chunks_in_flight = 16
+
+# Worker processes counting the occurrence table, by default as many as the CPUs this process may run on
+default_processes = int(os.environ.get('HARVEST_DWCA_PROCESSES', 0)) or len(os.sched_getaffinity(0))
+
+# Occurrence fields the counts are made of, by their Darwin Core or GBIF term name
+count_terms = ('publishingCountry', 'publishingOrgKey', 'datasetKey', 'basisOfRecord', 'issue', 'month')
+
+meta_namespace = '{http://rs.tdwg.org/dwc/text/}'
+
+
+@run_results.memoized(ignore=('processes',))
+@checkpoints.checkpointed('gbif_download', ignore=('processes',))
+def ingest_download(archive: str, processes: int = None) -> dict:
+    """ Counts the specimens, issues and flags of a GBIF occurrence download (Darwin Core Archive zip)
+        The occurrence table is streamed out of the zip without extracting it, workers count it chunk by chunk
+        :param archive: Path of the downloaded zip
+        :param processes: Number of worker processes, defaults to default_processes
+        :return: A dict of the 'specimens', 'issues_and_flags' and 'institutions', shaped like
+            gather_specimens(), gather_issues_flags() and gather_institutions()
+    """
+
+    counts = count_archive(archive, processes)
+
+    return {
+        'specimens': reshape_specimens(counts),
+        'issues_and_flags': reshape_issues_flags(counts),
+        'institutions': reshape_institutions(counts)
+    }
+
+
+def read_meta(archive: zipfile.ZipFile) -> dict:
+    """ Internal function of count_archive(), reads how the occurrence table of the archive is laid out
+        :return: A dict of the table's file name, encoding, delimiter, header lines and the column of each count term
+    """
+
+    core = ElementTree.fromstring(archive.read('meta.xml')).find(f'{meta_namespace}core')
+
+    if core.get('fieldsEnclosedBy', ''):
+        raise ValueError('Occurrence tables with quoted fields are not supported, request a DWCA download')
+
+    columns = {
+        field.get('term').rsplit('/', 1)[-1]: int(field.get('index')) for field in core.iter(f'{meta_namespace}field')
+    }
+    missing = [term for term in count_terms if term not in columns]
+
+    if missing:
+        raise ValueError(f'The occurrence table lacks the fields: {", ".join(missing)}')
+
+    return {
+        'location': core.find(f'{meta_namespace}files/{meta_namespace}location').text,
+        'encoding': core.get('encoding', 'UTF-8'),
+        'delimiter': core.get('fieldsTerminatedBy', '\\t').encode('utf-8').decode('unicode_escape'),
+        'header_lines': int(core.get('ignoreHeaderLines', 0)),
+        'columns': {term: columns[term] for term in count_terms}
+    }
+
+
+def count_archive(archive: str, processes: int = None) -> dict:
+    """ Internal function of ingest_download(), streams the occurrence table to worker processes and merges their counts
+        Only a few chunks are on their way at a time, so memory stays flat however large the archive
+        :return counts: The merged counts, as returned by count_chunk()
+    """
+
+    # More workers than chunks on their way would only wait
+    processes = min(processes or default_processes, max_chunks_in_flight)
+    in_flight = min(2 * processes, max_chunks_in_flight)
+    counts = None
+
+    # Workers start from a fresh server process instead of forking the harvest with its threads and connections
+    context = get_context('forkserver')
+
+    with zipfile.ZipFile(archive) as zip_file:
+        meta = read_meta(zip_file)
+
+        with zip_file.open(meta['location']) as table, \
+                ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+            for _ in range(meta['header_lines']):
+                table.readline()
+
+            pending = deque()
+            remainder = b''
+
+            while True:
+                data = table.read(chunk_size)
+
+                if not data:
+                    chunk, remainder = remainder, b''
+                elif b'\n' in data:
+                    # Whole lines go to the worker, the start of the last line waits for the next read
+                    end = data.rfind(b'\n') + 1
+                    chunk, remainder = remainder + data[:end], data[end:]
+                else:
+                    chunk, remainder = b'', remainder + data
+
+                if chunk:
+                    pending.append(executor.submit(count_chunk, chunk, meta['encoding'], meta['delimiter'],
+                                                   meta['columns']))
+
+                # Merge the oldest chunk before reading on once enough are in flight
+                while pending and (len(pending) >= in_flight or not data):
+                    counts = merge_counts(counts, pending.popleft().result())
+
+                if not data:
+                    break
+
+    logging.info(f'Counted {counts["occurrences"] if counts else 0} occurrences of {archive}')
+
+    return counts or count_chunk(b'', 'utf-8', '\t', {})
+
+
+def count_chunk(chunk: bytes, encoding: str, delimiter: str, columns: dict) -> dict:
+    """ Internal function of count_archive(), counts a chunk of whole lines of the occurrence table in a worker process
+        :return counts: A dict of counters by country or publisher, basis of record and issue with month,
+            and the set of datasets per publisher
+    """
+
+    counts: dict = {
+        'occurrences': 0,
+        'country_basis_of_record': Counter(),
+        'publisher_basis_of_record': Counter(),
+        'country_issues': Counter(),
+        'publisher_issues': Counter(),
+        'publisher_datasets': {}
+    }
+
+    if not chunk:
+        return counts
+
+    basis_of_record = set(GBIF_functions.basis_of_record)
+    country, publisher, dataset, record_basis, issues, month = (columns[term] for term in count_terms)
+
+    # Split no further than the last column that is counted
+    last = max(columns.values())
+
+    # Lines end at a newline only, like the chunks are cut, free text fields may hold other line breaks
+    for line in chunk.decode(encoding).split('\n'):
+        fields = line.removesuffix('\r').split(delimiter, last + 1)
+
+        if len(fields) <= last:
+            continue
+
+        counts['occurrences'] += 1
+        counts['publisher_datasets'].setdefault(fields[publisher], set()).add(fields[dataset])
+
+        if fields[record_basis] in basis_of_record:
+            counts['country_basis_of_record'][fields[country], fields[record_basis]] += 1
+            counts['publisher_basis_of_record'][fields[publisher], fields[record_basis]] += 1
+
+        if fields[issues]:
+            occurrence_month = int(fields[month]) if fields[month].isdigit() else 0
+
+            for issue in fields[issues].split(';'):
+                counts['country_issues'][fields[country], issue, occurrence_month] += 1
+                counts['publisher_issues'][fields[publisher], issue, occurrence_month] += 1
+
+    return counts
+
+
+def merge_counts(counts, chunk_counts: dict) -> dict:
+    """ Internal function of count_archive(), adds the counts of a chunk to the counts so far
+        :return counts: The merged counts
+    """
+
+    if counts is None:
+        return chunk_counts
+
+    counts['occurrences'] += chunk_counts['occurrences']
+
+    for counter in ('country_basis_of_record', 'publisher_basis_of_record', 'country_issues', 'publisher_issues'):
+        counts[counter].update(chunk_counts[counter])
+
+    for publisher, datasets in chunk_counts['publisher_datasets'].items():
+        counts['publisher_datasets'].setdefault(publisher, set()).update(datasets)
+
+    return counts
+
+
+def reshape_specimens(counts: dict) -> dict:
+    """ Reshapes the counts to the total specimens dict of gather_specimens()
+        :return total_specimens: A dict of the totals and the totals per country
+    """
+
+    total_specimens: dict = {
+        'total': {bor: 0 for bor in GBIF_functions.basis_of_record},
+        'countries': {}
+    }
+
+    for (country, bor), count in counts['country_basis_of_record'].items():
+        if country not in total_specimens['countries']:
+            total_specimens['countries'][country] = {'total': 0} | {b: 0 for b in GBIF_functions.basis_of_record}
+
+        total_specimens['countries'][country]['total'] += count
+        total_specimens['countries'][country][bor] += count
+        total_specimens['total'][bor] += count
+
+    return total_specimens
+
+
+def reshape_issues_flags(counts: dict) -> dict:
+    """ Reshapes the counts to the issues and flags dict of gather_issues_flags(), with monthly progress
+        :return issues_and_flags: A dict of the totals per country
+    """
+
+    issues_and_flags: dict = {
+        'total': 0, 'countries': {}
+    }
+
+    for (country, issue, month), count in counts['country_issues'].items():
+        country_issues = issues_and_flags['countries'].setdefault(country, {'total': 0})
+        issue_flag = country_issues.setdefault(GBIF_functions.issue_display_name(issue), {
+            'total': 0,
+            'monthly_progress': {m: 0 for m in range(1, 13)}
+        })
+
+        issue_flag['total'] += count
+        country_issues['total'] += count
+        issues_and_flags['total'] += count
+
+        if month in issue_flag['monthly_progress']:
+            issue_flag['monthly_progress'][month] += count
+
+    return issues_and_flags
+
+
+def reshape_institutions(counts: dict) -> dict:
+    """ Reshapes the counts to the publishers dict of gather_institutions(), with monthly progress
+        The datasets of a publisher are those with occurrences in the download
+        :return publishers: A dict of the publishers and their totals, issues and flags
+    """
+
+    publishers: dict = {}
+    publisher_index = GBIF_functions.load_publisher_index()
+
+    for publisher, datasets in counts['publisher_datasets'].items():
+        publishers[publisher] = {
+            'gbif_id': publisher,
+            'totals': {'datasets': len(datasets)} | {bor: 0 for bor in GBIF_functions.basis_of_record},
+            'issues_and_flags': {}
+        } | publisher_index.get(publisher, {})
+
+    for (publisher, bor), count in counts['publisher_basis_of_record'].items():
+        publishers[publisher]['totals'][bor] += count
+
+    for (publisher, issue, month), count in counts['publisher_issues'].items():
+        issue_flag = publishers[publisher]['issues_and_flags'].setdefault(GBIF_functions.issue_display_name(issue), {
+            'total': 0,
+            'monthly_progress': [0] * 12
+        })
+
+        issue_flag['total'] += count
+
+        if 1 <= month <= 12:
+            issue_flag['monthly_progress'][month - 1] += count
+
+    return publishers
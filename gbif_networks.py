@@ -0,0 +1,7 @@
+import os
+
+
+# GBIF networks to harvest, DiSSCo by default, GBIF_NETWORKS takes a comma separated list of network keys
+# Kept apart from the harvest, so the dashboard can select the data of a network without loading it
+network_key = '17abcf75-2f1e-46dd-bf75-a5b21dd02655'
+networks = [key.strip() for key in os.environ.get('GBIF_NETWORKS', network_key).split(',') if key.strip()]
@@ -0,0 +1,289 @@
+import contextvars
+import functools
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+# Prometheus textfile the metrics are written to at the end of each run, picked up by the node exporter
+metrics_file = os.environ.get('HARVEST_METRICS_FILE', 'metrics/harvest.prom')
+
+# Upper bounds of the request latency histogram, in seconds
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# The gather_* function a request is made for, set by the harvester decorator
+current_caller = contextvars.ContextVar('current_caller', default='unknown')
+
+key_pattern = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+metrics_lock = threading.Lock()
+requests_total: dict = {}
+retries_total: dict = {}
+hedges_total: dict = {}
+hedge_wins_total: dict = {}
+cache_hits_total: dict = {}
+coalesced_total: dict = {}
+response_bytes_total: dict = {}
+latency_counts: dict = {}
+latency_sums: dict = {}
+concurrency_limits: dict = {}
+
+# Start of the running harvest, set by start() so import and waiting for the run lock are not counted
+run_started = None
+
+
+def start():
+    """ Starts the duration of a harvest run
+    """
+
+    global run_started
+
+    run_started = time.time()
+
+
+def harvester(function):
+    """ Decorator that labels all requests made within the function, also from its worker threads, with its name
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = current_caller.set(function.__name__)
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current_caller.reset(token)
+
+    return wrapper
+
+
+def endpoint_label(url: str) -> str:
+    """ Turns a request url into its endpoint, replacing GBIF keys in the path so they share a label
+        :return: The host and path of the endpoint
+    """
+
+    split = urlsplit(url)
+
+    return split.hostname + key_pattern.sub('{key}', split.path)
+
+
+def observe_request(url: str, status, seconds: float, size: int):
+    """ Records a single request attempt
+        :param url: The requested url
+        :param status: The status code, or 'error' when no response was received
+        :param seconds: Time until the response was received
+        :param size: Size of the response body in bytes
+    """
+
+    labels = (endpoint_label(url), current_caller.get())
+
+    with metrics_lock:
+        requests_total[labels + (str(status),)] = requests_total.get(labels + (str(status),), 0) + 1
+        response_bytes_total[labels] = response_bytes_total.get(labels, 0) + size
+        latency_sums[labels] = latency_sums.get(labels, 0) + seconds
+
+        if labels not in latency_counts:
+            latency_counts[labels] = [0] * (len(latency_buckets) + 1)
+
+        for i, bucket in enumerate(latency_buckets):
+            if seconds <= bucket:
+                latency_counts[labels][i] += 1
+
+        latency_counts[labels][-1] += 1
+
+
+def observe_retry(url: str):
+    """ Records that a request is retried
+    """
+
+    labels = (endpoint_label(url), current_caller.get())
+
+    with metrics_lock:
+        retries_total[labels] = retries_total.get(labels, 0) + 1
+
+
+def observe_hedge(url: str):
+    """ Records that a slow request was sent once more
+    """
+
+    labels = (endpoint_label(url), current_caller.get())
+
+    with metrics_lock:
+        hedges_total[labels] = hedges_total.get(labels, 0) + 1
+
+
+def observe_hedge_win(url: str):
+    """ Records that the duplicate of a slow request responded first
+    """
+
+    labels = (endpoint_label(url), current_caller.get())
+
+    with metrics_lock:
+        hedge_wins_total[labels] = hedge_wins_total.get(labels, 0) + 1
+
+
+def observe_cache_hit(url: str):
+    """ Records that a response was served from the response cache
+    """
+
+    labels = (endpoint_label(url), current_caller.get())
+
+    with metrics_lock:
+        cache_hits_total[labels] = cache_hits_total.get(labels, 0) + 1
+
+
+def observe_coalesced(url: str):
+    """ Records that a request shared the response of an identical request of the run
+    """
+
+    labels = (endpoint_label(url), current_caller.get())
+
+    with metrics_lock:
+        coalesced_total[labels] = coalesced_total.get(labels, 0) + 1
+
+
+def observe_limit(host: str, limit: float):
+    """ Records the current adaptive concurrency limit of a host
+    """
+
+    with metrics_lock:
+        concurrency_limits[host] = limit
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    """ Internal function, formats label pairs, escaping the values as required by the exposition format
+        :return: The labels between braces
+    """
+
+    escaped = [str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values]
+
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def render() -> str:
+    """ Renders all recorded metrics in the Prometheus text exposition format
+        :return: The metrics as text
+    """
+
+    names = ('endpoint', 'caller')
+    lines = []
+
+    with metrics_lock:
+        lines += [
+            '# HELP harvest_http_requests_total HTTP request attempts made by the harvest.',
+            '# TYPE harvest_http_requests_total counter'
+        ]
+        lines += [
+            f'harvest_http_requests_total{format_labels(names + ("status",), labels)} {value}'
+            for labels, value in sorted(requests_total.items())
+        ]
+
+        lines += [
+            '# HELP harvest_http_retries_total HTTP requests that were retried.',
+            '# TYPE harvest_http_retries_total counter'
+        ]
+        lines += [
+            f'harvest_http_retries_total{format_labels(names, labels)} {value}'
+            for labels, value in sorted(retries_total.items())
+        ]
+
+        lines += [
+            '# HELP harvest_http_hedges_total Slow HTTP requests that were sent once more.',
+            '# TYPE harvest_http_hedges_total counter'
+        ]
+        lines += [
+            f'harvest_http_hedges_total{format_labels(names, labels)} {value}'
+            for labels, value in sorted(hedges_total.items())
+        ]
+
+        lines += [
+            '# HELP harvest_http_hedge_wins_total Hedged HTTP requests of which the duplicate responded first.',
+            '# TYPE harvest_http_hedge_wins_total counter'
+        ]
+        lines += [
+            f'harvest_http_hedge_wins_total{format_labels(names, labels)} {value}'
+            for labels, value in sorted(hedge_wins_total.items())
+        ]
+
+        lines += [
+            '# HELP harvest_cache_hits_total Responses served from the response cache.',
+            '# TYPE harvest_cache_hits_total counter'
+        ]
+        lines += [
+            f'harvest_cache_hits_total{format_labels(names, labels)} {value}'
+            for labels, value in sorted(cache_hits_total.items())
+        ]
+
+        lines += [
+            '# HELP harvest_coalesced_requests_total Requests that shared the response of an identical request of the run.',
+            '# TYPE harvest_coalesced_requests_total counter'
+        ]
+        lines += [
+            f'harvest_coalesced_requests_total{format_labels(names, labels)} {value}'
+            for labels, value in sorted(coalesced_total.items())
+        ]
+
+        lines += [
+            '# HELP harvest_http_response_bytes_total Size of the received response bodies.',
+            '# TYPE harvest_http_response_bytes_total counter'
+        ]
+        lines += [
+            f'harvest_http_response_bytes_total{format_labels(names, labels)} {value}'
+            for labels, value in sorted(response_bytes_total.items())
+        ]
+
+        lines += [
+            '# HELP harvest_http_request_duration_seconds Time until the response of a request attempt was received.',
+            '# TYPE harvest_http_request_duration_seconds histogram'
+        ]
+
+        for labels, counts in sorted(latency_counts.items()):
+            for bucket, count in zip(latency_buckets + ('+Inf',), counts):
+                lines.append(
+                    f'harvest_http_request_duration_seconds_bucket{format_labels(names + ("le",), labels + (bucket,))} {count}'
+                )
+
+            lines.append(f'harvest_http_request_duration_seconds_sum{format_labels(names, labels)} {latency_sums[labels]}')
+            lines.append(f'harvest_http_request_duration_seconds_count{format_labels(names, labels)} {counts[-1]}')
+
+        lines += [
+            '# HELP harvest_http_concurrency_limit Adaptive limit of requests in flight per host at the end of the run.',
+            '# TYPE harvest_http_concurrency_limit gauge'
+        ]
+        lines += [
+            f'harvest_http_concurrency_limit{format_labels(("host",), (host,))} {limit}'
+            for host, limit in sorted(concurrency_limits.items())
+        ]
+
+    if run_started is not None:
+        lines += [
+            '# HELP harvest_run_duration_seconds Duration of the last harvest run.',
+            '# TYPE harvest_run_duration_seconds gauge',
+            f'harvest_run_duration_seconds {time.time() - run_started}'
+        ]
+
+    lines += [
+        '# HELP harvest_last_run_timestamp_seconds End of the last harvest run.',
+        '# TYPE harvest_last_run_timestamp_seconds gauge',
+        f'harvest_last_run_timestamp_seconds {time.time()}'
+    ]
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path: str = None) -> str:
+    """ Writes the metrics to the Prometheus textfile, replacing it at once so the exporter never reads half a file
+        :return path: Path of the written file
+    """
+
+    path = path or metrics_file
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    with open(f'{path}.{os.getpid()}.tmp', 'w', encoding='utf-8') as file:
+        file.write(render())
+
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    return path
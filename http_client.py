@@ -0,0 +1,578 @@
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+# HTTP/2 is optional, without httpx and h2 all requests use HTTP/1.1
+try:
+    import h2.exceptions
+    import httpx
+except ImportError:
+    httpx = None
+
+# Internal functions
+import adaptive_limits
+import deadlines
+import harvest_metrics
+import response_cache
+import response_models
+
+
+# Size of the connection pool kept alive per harvested host, also the most requests in flight per host
+# Hosts are keyed by the network location of their urls, including the port where it is not the default
+host_pool_sizes = {
+    'api.gbif.org': 16,
+    'www.gbif.org': 16,
+    'geocase.eu': 4
+}
+default_pool_size = 4
+
+# Seconds to wait for a connection and for a response, per host
+host_timeouts = {
+    'api.gbif.org': (10, 60),
+    'www.gbif.org': (10, 180),
+    'geocase.eu': (10, 120)
+}
+default_timeout = (10, 60)
+
+# Retry behaviour, waiting between attempts with exponential backoff and full jitter
+max_retries = 5
+backoff_factor = 1
+backoff_max = 60
+retry_after_max = 300
+retry_statuses = {429, 500, 502, 503, 504}
+
+# Hedging: a request still waiting for its response after the usual latency of its endpoint is sent once more
+# and the first response wins, at most for a small share of the requests so a slow API is not flooded
+hedging = os.environ.get('HARVEST_HEDGE', 'on') != 'off'
+hedge_percentile = 0.95
+hedge_min_delay = 1.0
+hedge_min_samples = 20
+hedge_ratio = 0.05
+latency_window = 200
+
+# Optional HTTP/2 transport, multiplexing the concurrent requests to a host over a single connection
+# 'on' negotiates HTTP/2 with every https host, which falls back to HTTP/1.1 by itself where it is not supported
+# 'prior-knowledge' speaks HTTP/2 right away, also over plain http like the local stand-in
+# A host that does not understand HTTP/2 at all is switched back to the HTTP/1.1 session
+http2 = os.environ.get('HARVEST_HTTP2', 'off')
+http2_max_in_flight = 64
+
+session = None
+session_lock = threading.Lock()
+http2_client = None
+http2_hosts: set = set()
+http1_hosts: set = set()
+
+# Recent latencies and the number of requests and hedges per endpoint
+latency_samples: dict = {}
+hedge_counts: dict = {}
+hedge_lock = threading.Lock()
+hedge_executor = None
+
+# Decoded responses of the running harvest, keyed by canonical url and decode function
+# Identical requests, whether concurrent or repeated within a run, share one upstream request
+coalesced: dict = {}
+coalesced_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """ Creates the shared session on first use, mounting a pooled adapter per harvested host
+        Connections are kept alive and reused by every harvest request in the process
+        :return: session: The shared requests session
+    """
+
+    global session
+
+    with session_lock:
+        if session is None:
+            new_session = requests.Session()
+
+            for host, pool_size in host_pool_sizes.items():
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+                new_session.mount(f'https://{host}/', adapter)
+                new_session.mount(f'http://{host}/', adapter)
+
+            session = new_session
+
+    return session
+
+
+def get_http2_client():
+    """ Creates the shared HTTP/2 client on first use
+        :return: The shared httpx client
+    """
+
+    global http2_client
+
+    with session_lock:
+        if http2_client is None:
+            # httpx logs every request, which the harvest does not
+            logging.getLogger('httpx').setLevel(logging.WARNING)
+            http2_client = httpx.Client(
+                http1=http2 != 'prior-knowledge', http2=True, follow_redirects=True,
+                limits=httpx.Limits(max_connections=sum(host_pool_sizes.values()))
+            )
+
+    return http2_client
+
+
+def uses_http2(host: str) -> bool:
+    """ Tells whether requests to the host go over HTTP/2
+    """
+
+    if http2 == 'off' or host in http1_hosts:
+        return False
+
+    if httpx is None:
+        logging.warning('HTTP/2 needs httpx[http2], using HTTP/1.1')
+        http1_hosts.add(host)
+
+        return False
+
+    return True
+
+
+def max_in_flight(host: str) -> int:
+    """ Finds the most requests that may be in flight to the host
+        With HTTP/2 requests are multiplexed and no longer bound to the number of pooled connections
+        :return: The maximum of the host's adaptive limit
+    """
+
+    pool_size = host_pool_sizes.get(host, default_pool_size)
+
+    return max(pool_size, http2_max_in_flight) if uses_http2(host) else pool_size
+
+
+def get(url: str, params: dict = None, headers: dict = None) -> requests.Response:
+    """ Sends a GET request through the shared session
+        Retries on connection errors, timeouts and retryable status codes, within the deadline of the running stage
+        :return: response: The successful response, raises for any other status
+    """
+
+    host = urlsplit(url).netloc
+    limit = adaptive_limits.for_host(host, max_in_flight(host))
+    attempt = 0
+
+    while True:
+        try:
+            response = send_hedged(url, params, headers, limit)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            if attempt >= max_retries:
+                raise
+
+            delay = backoff_delay(attempt)
+            logging.warning(f'Request to {host} failed ({error}), retrying in {delay:.1f}s')
+        else:
+            if response.status_code not in retry_statuses or attempt >= max_retries:
+                response.raise_for_status()
+
+                return response
+
+            delay = retry_after_delay(response)
+
+            if delay is None:
+                delay = backoff_delay(attempt)
+
+            logging.warning(f'Request to {host} returned {response.status_code}, retrying in {delay:.1f}s')
+
+        left = deadlines.check(f'retrying {url}')
+
+        if left is not None and delay >= left:
+            raise deadlines.DeadlineExceeded(f'Stage deadline passes before {url} can be retried')
+
+        harvest_metrics.observe_retry(url)
+        time.sleep(delay)
+        attempt += 1
+
+
+def send(url: str, params: dict, headers: dict, limit: adaptive_limits.AdaptiveLimit,
+         acquired: bool = False, abandoned: threading.Event = None) -> requests.Response:
+    """ Internal function of get(), sends a single request attempt within the adaptive limit of the host
+        :param acquired: Whether a slot of the limit was already taken for the request
+        :param abandoned: Set once the attempt is no longer needed, like when a hedged attempt already succeeded
+        :return: The response, whatever its status, or None when the attempt was abandoned before it was sent
+    """
+
+    host = urlsplit(url).netloc
+    timeout = host_timeouts.get(host, default_timeout)
+
+    try:
+        left = deadlines.check(f'requesting {url}')
+    except deadlines.DeadlineExceeded:
+        if acquired:
+            limit.cancel()
+
+        raise
+
+    if left is not None:
+        # Never wait longer for a response than the stage has left
+        timeout = tuple(min(seconds, left) for seconds in timeout)
+
+    # Wait until the host's adaptive limit allows another request in flight
+    if not acquired and not limit.acquire(left):
+        raise deadlines.DeadlineExceeded(f'Stage deadline passed while waiting to request {url}')
+
+    if abandoned is not None and abandoned.is_set():
+        # The other attempt succeeded while this one waited, its slot goes to the next request
+        limit.cancel()
+
+        return None
+
+    started = time.perf_counter()
+
+    try:
+        response = transport_get(url, params, headers, timeout)
+    except BaseException:
+        seconds = time.perf_counter() - started
+        limit.release('error', seconds)
+        harvest_metrics.observe_request(url, 'error', seconds, 0)
+        harvest_metrics.observe_limit(host, limit.limit)
+
+        raise
+
+    seconds = time.perf_counter() - started
+    retry_after = retry_after_delay(response) if response.status_code in retry_statuses else None
+    limit.release(response.status_code, seconds, retry_after)
+    harvest_metrics.observe_request(url, response.status_code, seconds, len(response.content))
+    harvest_metrics.observe_limit(host, limit.limit)
+
+    if response.status_code < 400:
+        observe_latency(url, seconds)
+
+    return response
+
+
+def transport_get(url: str, params: dict, headers: dict, timeout: tuple) -> requests.Response:
+    """ Internal function of send(), sends the request over HTTP/2 where enabled, otherwise through the session
+        HTTP/2 errors are raised as their requests counterparts, so retries work the same for both
+        :return: The response, whatever its status
+    """
+
+    host = urlsplit(url).netloc
+
+    if not uses_http2(host):
+        return get_session().get(url, params=params, headers=headers, timeout=timeout)
+
+    try:
+        # The canonical url encodes the parameters the same way requests does
+        response = get_http2_client().get(canonical_url(url, params), headers=headers,
+                                          timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+    except httpx.TimeoutException as error:
+        raise requests.Timeout(error) from error
+    except (httpx.RemoteProtocolError, h2.exceptions.ProtocolError) as error:
+        if host in http2_hosts:
+            raise requests.ConnectionError(error) from error
+
+        # The host never answered over HTTP/2, so it does not speak it
+        logging.warning(f'{host} does not support HTTP/2 ({error}), using HTTP/1.1')
+        http1_hosts.add(host)
+
+        return get_session().get(url, params=params, headers=headers, timeout=timeout)
+    except httpx.TransportError as error:
+        raise requests.ConnectionError(error) from error
+
+    if response.http_version == 'HTTP/2':
+        http2_hosts.add(host)
+
+    # Callers handle a single kind of response
+    converted = requests.Response()
+    converted.status_code = response.status_code
+    converted.reason = response.reason_phrase
+    converted.headers = CaseInsensitiveDict(response.headers)
+    converted.url = str(response.url)
+    converted.encoding = response.encoding
+    converted._content = response.content
+
+    return converted
+
+
+def send_hedged(url: str, params: dict, headers: dict, limit: adaptive_limits.AdaptiveLimit) -> requests.Response:
+    """ Internal function of get(), sends a request attempt and a duplicate of it once the first one is slow
+        :return: The first successful response of either
+    """
+
+    endpoint = harvest_metrics.endpoint_label(url)
+    threshold = hedge_threshold(endpoint)
+
+    if threshold is None:
+        return send(url, params, headers, limit)
+
+    # Both requests run in a copy of the current context, keeping the metrics caller label and stage deadline
+    executor = get_hedge_executor()
+    abandoned = threading.Event()
+    primary = executor.submit(contextvars.copy_context().run, send, url, params, headers, limit, False, abandoned)
+    done, _ = wait([primary], timeout=threshold)
+
+    # The duplicate does not wait for a slot, it would not be any faster than the request it hedges
+    if done or not reserve_hedge(endpoint) or not limit.acquire_extra():
+        return primary.result()
+
+    harvest_metrics.observe_hedge(url)
+    hedge = executor.submit(contextvars.copy_context().run, send, url, params, headers, limit, True, abandoned)
+    pending = {primary, hedge}
+
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        successful = [future for future in done if future.exception() is None]
+
+        if successful:
+            if hedge in successful and primary not in successful:
+                harvest_metrics.observe_hedge_win(url)
+
+            abandon(pending | set(successful[1:]), hedge, limit, abandoned)
+
+            return successful[0].result()
+
+        if not pending:
+            return done.pop().result()
+
+
+def abandon(losers: set, hedge: Future, limit: adaptive_limits.AdaptiveLimit, abandoned: threading.Event):
+    """ Internal function of send_hedged(), stops the attempts of a request that are no longer needed
+        Attempts that did not start are cancelled, attempts waiting for a slot give it up and the responses of
+        attempts in flight are closed once they arrive
+    """
+
+    abandoned.set()
+
+    for future in losers:
+        if future.cancel():
+            if future is hedge:
+                # The slot taken for the hedge was never used
+                limit.cancel()
+        else:
+            future.add_done_callback(close_response)
+
+
+def close_response(future: Future):
+    """ Internal function of abandon(), closes the response of an attempt that lost
+    """
+
+    if not future.cancelled() and future.exception() is None and future.result() is not None:
+        future.result().close()
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """ Internal function of send_hedged(), creates the worker threads of hedged requests on first use
+        :return: The shared executor
+    """
+
+    global hedge_executor
+
+    with hedge_lock:
+        if hedge_executor is None:
+            # Enough workers for every connection to be busy twice, the adaptive limits bound what is in flight
+            hedge_executor = ThreadPoolExecutor(max_workers=2 * sum(host_pool_sizes.values()),
+                                                thread_name_prefix='hedge')
+
+    return hedge_executor
+
+
+def observe_latency(url: str, seconds: float):
+    """ Internal function of send(), keeps the recent latencies of successful requests per endpoint
+    """
+
+    endpoint = harvest_metrics.endpoint_label(url)
+
+    with hedge_lock:
+        if endpoint not in latency_samples:
+            latency_samples[endpoint] = deque(maxlen=latency_window)
+
+        latency_samples[endpoint].append(seconds)
+
+
+def hedge_threshold(endpoint: str):
+    """ Internal function of send_hedged(), finds after how long a request to the endpoint is hedged
+        :return: Number of seconds, or None when requests to the endpoint are not hedged (yet)
+    """
+
+    if not hedging:
+        return None
+
+    with hedge_lock:
+        samples = sorted(latency_samples.get(endpoint, ()))
+        counts = hedge_counts.setdefault(endpoint, [0, 0])
+        counts[0] += 1
+
+    if len(samples) < hedge_min_samples:
+        return None
+
+    return max(hedge_min_delay, samples[int(hedge_percentile * (len(samples) - 1))])
+
+
+def reserve_hedge(endpoint: str) -> bool:
+    """ Internal function of send_hedged(), keeps hedges within their share of the requests to the endpoint
+        :return: Whether the request may be hedged
+    """
+
+    with hedge_lock:
+        counts = hedge_counts[endpoint]
+
+        if counts[1] + 1 > hedge_ratio * counts[0]:
+            return False
+
+        counts[1] += 1
+
+    return True
+
+
+def get_json(url: str, params: dict = None) -> dict:
+    """ Sends a GET request through the shared session and decodes the JSON body
+        The decoded response is shared with identical requests of the run, so it must not be changed
+        :return: The decoded response
+    """
+
+    return coalesce(canonical_url(url, params), None, lambda: response_models.loads(get_body(url, params)))
+
+
+def get_decoded(url: str, params: dict, decode, keep: bool = True):
+    """ Sends a GET request through the shared session and decodes the JSON body into a typed structure
+        The typed response is shared with identical requests of the run, so it must not be changed
+        :param decode: One of the decode functions of response_models
+        :param keep: Whether later requests of the run reuse the response, otherwise it is only shared while in flight,
+            like for listing pages that are dropped once handled
+        :return: The typed response
+    """
+
+    return coalesce(canonical_url(url, params), decode, lambda: decode(get_body(url, params)), keep)
+
+
+def coalesce(request_url: str, decode, fetch, keep: bool = True):
+    """ Internal function, makes identical requests share one upstream request
+        The first caller fetches, concurrent callers wait for its result and later callers of the run reuse it
+        A failed request is not kept, so the next caller tries again
+        :param decode: The decode function, as the same url may be decoded differently
+        :param fetch: Function that requests and decodes the response
+        :param keep: Whether to keep the response for later callers of the run once the request completed
+        :return: The decoded response
+    """
+
+    key = (request_url, decode)
+
+    with coalesced_lock:
+        future = coalesced.get(key)
+        owner = future is None
+
+        if owner:
+            future = coalesced[key] = Future()
+
+    if not owner:
+        harvest_metrics.observe_coalesced(request_url)
+
+        return future.result()
+
+    try:
+        future.set_result(fetch())
+    except BaseException as error:
+        with coalesced_lock:
+            coalesced.pop(key, None)
+
+        future.set_exception(error)
+
+        raise
+
+    if not keep:
+        # Callers that already waited hold the future, later callers request anew
+        with coalesced_lock:
+            coalesced.pop(key, None)
+
+    return future.result()
+
+
+def forget_coalesced():
+    """ Drops the shared responses at the end of a run, so the next run requests everything again
+    """
+
+    with coalesced_lock:
+        coalesced.clear()
+
+
+def get_body(url: str, params: dict = None, cache: bool = True) -> str:
+    """ Sends a GET request through the shared session
+        Fresh responses come out of the response cache, stale ones are revalidated with the API
+        :param cache: Whether to use the response cache, off for single-use responses like cursor pages
+        :return: The response body
+    """
+
+    if not cache:
+        return get(url, params).text
+
+    request_url = canonical_url(url, params)
+    entry = response_cache.lookup(request_url)
+
+    if entry is not None and response_cache.is_fresh(entry):
+        response_cache.touch(request_url)
+        harvest_metrics.observe_cache_hit(url)
+
+        return entry['body']
+
+    response = get(url, params, response_cache.validators(entry) if entry else None)
+
+    if response.status_code == 304 and entry is not None:
+        entry = response_cache.revalidated(entry)
+    else:
+        entry = response_cache.store(request_url, response.text, response.headers)
+
+    return entry['body']
+
+
+def canonical_url(url: str, params: dict = None) -> str:
+    """ Builds a canonical form of the url and its parameters, independent of the parameter order
+        :return: The url with its sorted, encoded parameters
+    """
+
+    if not params:
+        return url
+
+    items = []
+
+    for key in sorted(params):
+        value = params[key]
+
+        if isinstance(value, (list, tuple)):
+            items.extend((key, v) for v in value)
+        else:
+            items.append((key, value))
+
+    return url + '?' + urlencode(items)
+
+
+def backoff_delay(attempt: int) -> float:
+    """ Calculates the exponential backoff with full jitter for the given attempt
+        :return: Number of seconds to wait
+    """
+
+    return random.uniform(0, min(backoff_max, backoff_factor * 2 ** attempt))
+
+
+def retry_after_delay(response: requests.Response):
+    """ Reads the Retry-After header, which is either a number of seconds or an HTTP date
+        :return: Number of seconds to wait, or None when the header is absent or invalid
+    """
+
+    retry_after = response.headers.get('Retry-After')
+
+    if retry_after is None:
+        return None
+
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+
+    return min(max(delay, 0), retry_after_max)
@@ -1,4 +1,6 @@
 import logging
+from datetime import datetime as dt
+from functools import partial
 
 
 # GBIF API functionality
@@ -7,12 +9,43 @@ import GBIF_functions
 import GeoCASe_functions
 # CSV files functionality
 import csv_functions
+# Resuming failed runs
+import checkpoints
+# Harvest metrics for Prometheus
+import harvest_metrics
+# Cached API responses
+import response_cache
+# Run deadline split across the harvest stages
+import deadlines
+# Shared HTTP client
+import http_client
+# Running the jobs as a dependency graph
+import pipeline
+# One run of the same request and month at a time
+import run_lock
+# Harvest results shared within the run
+import run_results
 
 
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
 
-
-def main(request=None):
+# Harvest stages each request goes through, the run deadline is split across them
+request_stages = {
+    'all': [
+        'gather_datasets', 'gather_specimens', 'gather_issues_flags', 'gather_institutions', 'gather_data',
+        'gather_publishers'
+    ],
+    'gbif_datasets': ['gather_datasets'],
+    'gbif_specimens': ['gather_specimens'],
+    'gbif_issues_flags': ['gather_issues_flags'],
+    'gbif_issues_flags_monthly': ['gather_issues_flags'],
+    'gbif_institutions': ['gather_institutions'],
+    'geocase_specimens': ['gather_data'],
+    'geocase_publishers': ['gather_publishers']
+}
+
+
+def main(request=None, force_refresh=False):
     options_list = [
         'all',
         'gbif_datasets',
@@ -31,6 +64,23 @@ def main(request=None):
         request = input('\nSelect an option: ')
 
     if request in options_list:
+        run_id = f'main-{request}-{dt.now().strftime("%Y-%m")}'
+
+        # The same request running in another process is waited for and reused, or left to it
+        with run_lock.single_flight(run_id, rerun=force_refresh) as should_run:
+            if should_run:
+                run_request(request, run_id, force_refresh)
+
+
+def run_request(request: str, run_id: str, force_refresh=False):
+    harvest_metrics.start()
+    # Resume the same request of this month if it failed before
+    checkpoints.start(run_id, resume=not force_refresh)
+    deadlines.start(request_stages[request])
+    # Ignore cached API responses if requested, for this run only
+    refresh = response_cache.force_refresh.set(force_refresh or response_cache.force_refresh.get())
+
+    try:
         # Check which function
         match request:
             case 'all':
@@ -57,62 +107,103 @@ def main(request=None):
             case 'geocase_publishers':
                 # Call on GeoCASe publishers
                 geocase_publishers()
+    finally:
+        # Export the harvest metrics, also of failed runs
+        harvest_metrics.write_textfile()
+        run_results.persist()
+        run_results.forget()
+        http_client.forget_coalesced()
+        deadlines.complete()
+        response_cache.force_refresh.reset(refresh)
+
+    # Run completed, next run starts fresh
+    checkpoints.complete()
+    run_lock.complete(run_id)
 
 
-# Call on all functions, one at a time
+# Call on all functions, every harvest at the same time and every csv as soon as its data is there
 def execute_all():
-    logging.info('Now executing all methods, one at a time')
-    total_count = 6
-    progress = 0
-
-    # GBIF datasets
-    gbif_datasets()
-    progress += 1
-    logging.info(f'Completed: {progress} out of {total_count}')
-
-    # GBIF specimens
-    gbif_specimens()
-    progress += 1
-    logging.info(f'Completed: {progress} out of {total_count}')
-
-    # GBIF issues and flags
-    gbif_issues_flags()
-    progress += 1
-    logging.info(f'Completed: {progress} out of {total_count}')
-
-    # This part is currently not being used
-    # GBIF issues and flags monthly
-    # gbif_issues_flags_monthly()
-    # progress += 1
-    # logging.info(f'Completed: {progress} out of {total_count}')
-
-    # GBIF institutions
-    gbif_institutions()
-    progress += 1
-    logging.info(f'Completed: {progress} out of {total_count}')
-
-    # GeoCASe data
-    geocase_specimens()
-    progress += 1
-    logging.info(f'Completed: {progress} out of {total_count}')
-
-    # GeoCASe publishers
-    geocase_publishers()
-    progress += 1
-    logging.info(f'Completed: {progress} out of {total_count}')
+    logging.info('Now executing all methods')
+
+    # GBIF issues and flags monthly progress is currently not being used
+    jobs = {
+        'gather_datasets': {
+            'run': partial(GBIF_functions.harvest_networks, GBIF_functions.gather_datasets)
+        },
+        'write_datasets': {
+            'run': partial(write_networks, csv_functions.write_datasets_to_csv),
+            'after': ['gather_datasets']
+        },
+        'gather_specimens': {
+            'run': partial(GBIF_functions.harvest_networks, GBIF_functions.gather_specimens)
+        },
+        'write_specimens': {
+            'run': partial(write_networks, csv_functions.write_specimens_to_csv),
+            'after': ['gather_specimens']
+        },
+        'gather_issues_flags': {
+            'run': partial(GBIF_functions.harvest_networks, GBIF_functions.gather_issues_flags, monthly_progress=False)
+        },
+        'write_issues_flags': {
+            'run': partial(write_networks, csv_functions.write_issues_and_flags_to_csv),
+            'after': ['gather_issues_flags']
+        },
+        'gather_institutions': {
+            'run': partial(GBIF_functions.harvest_networks, GBIF_functions.gather_institutions, monthly_progress=False)
+        },
+        'write_institutions': {
+            'run': partial(write_networks, csv_functions.write_institution_to_csv),
+            'after': ['gather_institutions']
+        },
+        'gather_data': {
+            'run': GeoCASe_functions.gather_data
+        },
+        'write_geocase_specimens': {
+            'run': csv_functions.write_geocase_specimens_to_csv,
+            'after': ['gather_data']
+        },
+        'gather_publishers': {
+            'run': GeoCASe_functions.gather_publishers
+        },
+        'write_geocase_publishers': {
+            'run': csv_functions.write_geocase_publishers_to_csv,
+            'after': ['gather_publishers']
+        }
+    }
+
+    report = pipeline.run_pipeline(jobs)
+    pipeline.log_report(report)
 
     logging.info('\nProcess done!')
 
 
 # GBIF functions
+def csv_network(network: str):
+    """ DiSSCo keeps its csv file names, the files of other GBIF networks carry their key
+        :return: The network key to name the csv files by, or None for DiSSCo
+    """
+
+    return None if network == GBIF_functions.network_key else network
+
+
+def write_networks(write, data: dict) -> str:
+    """ Writes the data of every GBIF network to its own csv
+        :param write: The csv_functions writer
+        :param data: Dict of the data per network, from harvest_networks()
+        :return: The names of the csv files, joined
+    """
+
+    return ', '.join(write(network_data, csv_network(network)) for network, network_data in data.items())
+
+
 def gbif_datasets():
     # First collect and prepare datasets data
     logging.info('\nReceiving datasets data from GBIF...')
-    data = GBIF_functions.gather_datasets()
+    data = GBIF_functions.harvest_networks(GBIF_functions.gather_datasets)
 
     # Then write data to csv
     logging.info('\nData fetched and prepared, now writing to CSV...')
-    csv_file = csv_functions.write_datasets_to_csv(data)
+    csv_file = write_networks(csv_functions.write_datasets_to_csv, data)
 
     # Finishing statement
     logging.info(f'\nProcess finished! CSV was saved in: "{csv_file}"')
@@ -121,11 +212,11 @@ def gbif_datasets():
 def gbif_specimens():
     # First collect and prepare specimens data
     logging.info('\nReceiving specimens data from GBIF...')
-    data = GBIF_functions.gather_specimens()
+    data = GBIF_functions.harvest_networks(GBIF_functions.gather_specimens)
 
     # Then write data to csv
     logging.info('\nData fetched and prepared, now writing to CSV...')
-    csv_file = csv_functions.write_specimens_to_csv(data)
+    csv_file = write_networks(csv_functions.write_specimens_to_csv, data)
 
     # Finishing statement
     logging.info(f'\nProcess finished! CSV was saved in: "{csv_file}"')
@@ -134,11 +225,11 @@ def gbif_specimens():
 def gbif_issues_flags():
     # First collect and prepare issues and flags data
     logging.info('\nReceiving issues and flags data from GBIF...')
-    data = GBIF_functions.gather_issues_flags()
+    data = GBIF_functions.harvest_networks(GBIF_functions.gather_issues_flags, monthly_progress=False)
 
     # Then write data to csv
     logging.info('\nData fetched and prepared, now writing to CSV...')
-    csv_file = csv_functions.write_issues_and_flags_to_csv(data)
+    csv_file = write_networks(csv_functions.write_issues_and_flags_to_csv, data)
 
     # Finishing statement
     logging.info(f'\nProcess finished! CSV was saved in: "{csv_file}"')
@@ -147,11 +238,11 @@ def gbif_issues_flags():
 def gbif_issues_flags_monthly():
     # First collect and prepare issues and flags data
     logging.info('\nReceiving issues and flags data from GBIF...')
-    data = GBIF_functions.gather_issues_flags()
+    data = GBIF_functions.harvest_networks(GBIF_functions.gather_issues_flags)
 
     # Then write data to csv
     logging.info('\nData fetched and prepared, now writing to CSV...')
-    csv_file = csv_functions.write_issues_and_flags_monthly_to_csv(data)
+    csv_file = write_networks(csv_functions.write_issues_and_flags_monthly_to_csv, data)
 
     # Finishing statement
     logging.info(f'\nProcess finished! CSV was saved in: "{csv_file}"')
@@ -160,11 +251,11 @@ def gbif_issues_flags_monthly():
 def gbif_institutions():
     # First collect and prepare institutions data
     logging.info('\nReceiving institutions data from GBIF...')
-    data = GBIF_functions.gather_institutions()
+    data = GBIF_functions.harvest_networks(GBIF_functions.gather_institutions, monthly_progress=False)
 
     # Then write data to csv
     logging.info('\nData fetched and prepared, now writing to CSV...')
-    csv_file = csv_functions.write_institution_to_csv(data)
+    csv_file = write_networks(csv_functions.write_institution_to_csv, data)
 
     # Finishing statement
     logging.info(f'\nProcess finished! CSVs were saved in: "{csv_file}"')
@@ -198,4 +289,5 @@ def geocase_publishers():
 
 
 # Call on main function
-main()
+if __name__ == '__main__':
+    main()
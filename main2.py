@@ -1,45 +1,187 @@
 import logging
+import os
+from datetime import datetime as dt
+from functools import partial
 
 
 # GBIF API functionality
 import GBIF_functions
 # GeoCASe API functionality
 import GeoCASe_functions
+# Counting GBIF occurrence downloads
+import dwca_ingest
 import query_database
+# Cached API responses
+import response_cache
+# Run deadline split across the harvest stages
+import deadlines
+# Shared HTTP client
+import http_client
+# Harvest results shared within the run
+import run_results
+# Resuming failed runs
+import checkpoints
+# Harvest metrics for Prometheus
+import harvest_metrics
+# Running the harvest and inserts as a dependency graph
+import pipeline
+# Splitting the harvest over several processes or pods
+import sharding
+# One run of the same month at a time
+import run_lock
 
 
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
 
 
-def process_countries():
-    logging.info('Receiving countries datasets data from GBIF...')
-    gbif_datasets = GBIF_functions.gather_datasets()
-
-    logging.info('Receiving countries specimens data from GBIF...')
-    gbif_specimens = GBIF_functions.gather_specimens()
-
-    logging.info('Receiving countries issues and flags data from GBIF...')
-    gbif_issues_flags = GBIF_functions.gather_issues_flags()
-
-    logging.info('Receiving countries data from GeoCASe...')
-    geocase_data = GeoCASe_functions.gather_data()
-
-    query_database.insert_countries_data(gbif_datasets, gbif_specimens, gbif_issues_flags, geocase_data)
-
-
-def process_organisations():
-    logging.info('Receiving organisations datasets data from GBIF...')
-    gbif_organisations_data = GBIF_functions.gather_institutions()
-
-    logging.info('Receiving organisations data from GeoCASe...')
-    geocase_data = GeoCASe_functions.gather_publishers()
-
-    query_database.insert_organisations_data(gbif_organisations_data, geocase_data)
-
-
-def main2():
-    process_countries()
-    process_organisations()
-
-
-main2()
+def harvest_or_ingest(stage, networks: list, download: str = None, part: str = None) -> dict:
+    # The occurrence download of the DiSSCo network replaces its API requests, other networks are still harvested
+    if not download or GBIF_functions.network_key not in networks:
+        return GBIF_functions.harvest_networks(stage, networks)
+
+    others = [network for network in networks if network != GBIF_functions.network_key]
+    results = GBIF_functions.harvest_networks(stage, others) if others else {}
+
+    return results | {GBIF_functions.network_key: dwca_ingest.ingest_download(download)[part]}
+
+
+def countries_jobs(networks: list = None, download: str = None) -> dict:
+    networks = networks or GBIF_functions.networks
+
+    # Every GBIF stage runs for all networks at once, next to the GeoCASe harvest
+    return {
+        'countries_gbif_datasets': {
+            'run': partial(GBIF_functions.harvest_networks, GBIF_functions.gather_datasets, networks)
+        },
+        'countries_gbif_specimens': {
+            'run': partial(harvest_or_ingest, GBIF_functions.gather_specimens, networks, download, 'specimens')
+        },
+        'countries_gbif_issues_flags': {
+            'run': partial(harvest_or_ingest, GBIF_functions.gather_issues_flags, networks, download,
+                           'issues_and_flags')
+        },
+        'countries_geocase_data': {
+            'run': GeoCASe_functions.gather_data
+        },
+        'insert_countries': {
+            'run': partial(insert_countries, networks),
+            'after': [
+                'countries_gbif_datasets', 'countries_gbif_specimens', 'countries_gbif_issues_flags',
+                'countries_geocase_data'
+            ]
+        }
+    }
+
+
+def insert_countries(networks: list, gbif_datasets: dict, gbif_specimens: dict, gbif_issues_flags: dict,
+                     geocase_data: dict):
+    for network in networks:
+        query_database.insert_countries_data(gbif_datasets[network], gbif_specimens[network],
+                                             gbif_issues_flags[network], geocase_data, network)
+
+
+def organisations_jobs(networks: list = None, download: str = None) -> dict:
+    networks = networks or GBIF_functions.networks
+
+    return {
+        'organisations_gbif_institutions': {
+            'run': partial(harvest_or_ingest, GBIF_functions.gather_institutions, networks, download, 'institutions')
+        },
+        'organisations_geocase_publishers': {
+            'run': GeoCASe_functions.gather_publishers
+        },
+        'insert_organisations': {
+            'run': partial(insert_organisations, networks),
+            'after': ['organisations_gbif_institutions', 'organisations_geocase_publishers']
+        }
+    }
+
+
+def insert_organisations(networks: list, gbif_organisations_data: dict, geocase_data: dict):
+    for network in networks:
+        query_database.insert_organisations_data(gbif_organisations_data[network], geocase_data, network)
+
+
+def process_countries(networks: list = None, download: str = None):
+    pipeline.run_pipeline(countries_jobs(networks, download))
+
+
+def process_organisations(networks: list = None, download: str = None):
+    pipeline.run_pipeline(organisations_jobs(networks, download))
+
+
+def main2(force_refresh=False, download=None):
+    run_id = f'main2-{dt.now().strftime("%Y-%m")}'
+
+    # A run of this month in another process or pod is waited for and reused, or left to it
+    with run_lock.single_flight(run_id, rerun=force_refresh) as should_run:
+        if should_run:
+            run_main2(run_id, force_refresh, download)
+
+
+def run_main2(run_id: str, force_refresh=False, download=None):
+    # Count specimens, issues and flags from a GBIF occurrence download instead of the API, if given
+    download = download or os.environ.get('GBIF_DOWNLOAD')
+
+    harvest_metrics.start()
+    # Resume this month's run if it failed before
+    checkpoints.start(run_id, resume=not force_refresh)
+    deadlines.start([
+        'gather_datasets', 'gather_specimens', 'gather_issues_flags', 'gather_data', 'gather_institutions',
+        'gather_publishers'
+    ])
+    # Ignore cached API responses if requested, for this run only
+    refresh = response_cache.force_refresh.set(force_refresh or response_cache.force_refresh.get())
+
+    try:
+        # Countries and organisations are harvested and inserted at the same time
+        report = pipeline.run_pipeline(countries_jobs(download=download) | organisations_jobs(download=download))
+        pipeline.log_report(report)
+    finally:
+        # Export the harvest metrics, also of failed runs
+        harvest_metrics.write_textfile()
+        run_results.persist()
+        run_results.forget()
+        http_client.forget_coalesced()
+        deadlines.complete()
+        response_cache.force_refresh.reset(refresh)
+
+    # Run completed, next run starts fresh
+    checkpoints.complete()
+    run_lock.complete(run_id)
+
+
+def main2_shard(index: int, count: int, force_refresh=False, download=None):
+    # Every shard harvests the issues and flags of its countries and publishers
+    run_id = f'main2-{dt.now().strftime("%Y-%m")}'
+    harvest_metrics.start()
+    checkpoints.start(f'{run_id}-shard-{index}-of-{count}', resume=not force_refresh)
+    deadlines.start(sharding.sharded_stages)
+    refresh = response_cache.force_refresh.set(force_refresh or response_cache.force_refresh.get())
+
+    sharding.clear(run_id)
+
+    try:
+        path = sharding.write_shard(run_id, index, count, sharding.harvest_shard(index, count))
+        logging.info(f'Shard {index} of {count} was saved in: "{path}"')
+    finally:
+        harvest_metrics.write_textfile()
+        run_results.forget()
+        http_client.forget_coalesced()
+        deadlines.complete()
+        response_cache.force_refresh.reset(refresh)
+
+    checkpoints.complete()
+
+    # The first shard merges all shards and runs the rest of the harvest and the inserts
+    if index == 0:
+        sharding.remember(sharding.merge_shards(sharding.read_shards(run_id, count)))
+        main2(force_refresh, download)
+        sharding.remove(run_id)
+
+
+if __name__ == '__main__':
+    if sharding.shard_count > 1:
+        main2_shard(sharding.shard_index, sharding.shard_count)
+    else:
+        main2()
@@ -1,20 +1,25 @@
-from sqlalchemy import Table, Column, MetaData, Integer, String, DATETIME, JSON
+from sqlalchemy import Table, Column, MetaData, Integer, String, DATETIME, JSON, UniqueConstraint
 
 
-def countries_model():
-    metadata = MetaData()
+# Defined once per process, the table is shared by all queries
+metadata = MetaData()
+
+countries = Table(
+    'countries',
+    metadata,
+    Column('id', Integer, primary_key=True),
+    Column('country_code', String(3), nullable=False),
+    Column('country_name', String(60), nullable=False),
+    Column('last_updated', DATETIME),
+    Column('datasets_count', JSON, nullable=True),
+    Column('specimens_count', JSON, nullable=True),
+    Column('issues_flags', JSON, nullable=True),
+    Column('month', String, nullable=False),
+    Column('network_key', String(36), nullable=False),
+    # The upserts depend on this constraint, query_database adds the network key to it in existing databases
+    UniqueConstraint('country_code', 'month', 'network_key', name='countries_un')
+)
 
-    countries = Table(
-        'countries',
-        metadata,
-        Column('id', Integer, primary_key=True),
-        Column('country_code', String(3), nullable=False),
-        Column('country_name', String(60), nullable=False),
-        Column('last_updated', DATETIME),
-        Column('datasets_count', JSON, nullable=True),
-        Column('specimens_count', JSON, nullable=True),
-        Column('issues_flags', JSON, nullable=True),
-        Column('month', String, nullable=False)
-    )
 
+def countries_model():
     return countries
@@ -0,0 +1,16 @@
+from sqlalchemy import Table, Column, MetaData, String, DateTime
+
+
+# Defined once per process, the table is shared by all queries
+metadata = MetaData()
+
+harvest_runs = Table(
+    'harvest_runs',
+    metadata,
+    Column('run_id', String(100), primary_key=True),
+    Column('completed', DateTime, nullable=False)
+)
+
+
+def harvest_runs_model():
+    return harvest_runs
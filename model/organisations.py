@@ -1,20 +1,25 @@
-from sqlalchemy import Table, Column, MetaData, Integer, String, DATETIME, JSON
+from sqlalchemy import Table, Column, MetaData, Integer, String, DATETIME, JSON, UniqueConstraint
 
 
-def organisations_model():
-    metadata = MetaData()
+# Defined once per process, the table is shared by all queries
+metadata = MetaData()
+
+organisations = Table(
+    'organisations',
+    metadata,
+    Column('id', Integer, primary_key=True),
+    Column('ror_id', String(50), nullable=False),
+    Column('organisation_name', String(200), nullable=False),
+    Column('last_updated', DATETIME),
+    Column('datasets_count', JSON, nullable=True),
+    Column('specimens_count', JSON, nullable=True),
+    Column('issues_flags', JSON, nullable=True),
+    Column('month', String, nullable=False),
+    Column('network_key', String(36), nullable=False),
+    # The upserts depend on this constraint, query_database adds the network key to it in existing databases
+    UniqueConstraint('ror_id', 'month', 'network_key', name='organisations_un')
+)
 
-    organisations = Table(
-        'organisations',
-        metadata,
-        Column('id', Integer, primary_key=True),
-        Column('ror_id', String(50), nullable=False),
-        Column('organisation_name', String(200), nullable=False),
-        Column('last_updated', DATETIME),
-        Column('datasets_count', JSON, nullable=True),
-        Column('specimens_count', JSON, nullable=True),
-        Column('issues_flags', JSON, nullable=True),
-        Column('month', String, nullable=False)
-    )
 
+def organisations_model():
     return organisations
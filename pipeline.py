@@ -0,0 +1,129 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Internal functions
+import deadlines
+
+
+# Number of jobs of a pipeline that run at the same time
+default_workers = 6
+
+
+def run_pipeline(jobs: dict, workers: int = default_workers) -> dict:
+    """ Runs a dependency graph of jobs, each job as soon as the jobs it depends on are done
+        Independent jobs, like the GBIF and GeoCASe harvests, run at the same time on a pool of workers
+        :param jobs: Dict of the name of each job to a dict of its 'run' function and the names of the jobs it
+            runs 'after', whose results are passed to the function in that order
+        :param workers: Maximum number of jobs running at the same time
+        :return report: A dict of the 'results' and 'timings' per job, the 'critical_path' and the 'duration'
+    """
+
+    check_graph(jobs)
+
+    results: dict = {}
+    timings: dict = {}
+    waiting = dict(jobs)
+    running: dict = {}
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while waiting or running:
+                # Start every job of which all dependencies are done
+                ready = [name for name, job in waiting.items() if all(after in results for after in job.get('after', ()))]
+
+                for name in ready:
+                    job = waiting.pop(name)
+                    logging.info(f'Starting {name}...')
+                    arguments = [results[after] for after in job.get('after', ())]
+                    # Jobs run next to each other, so their stages share the run deadline instead of a slice of it
+                    context = contextvars.copy_context()
+                    context.run(deadlines.concurrent_stage.set, True)
+                    running[executor.submit(context.run, timed, job['run'], arguments)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    name = running.pop(future)
+                    results[name], start, end = future.result()
+                    timings[name] = (start - started, end - started)
+                    logging.info(f'Completed {name} in {end - start:.1f}s: {len(results)} out of {len(jobs)}')
+        except BaseException:
+            # Jobs that have not started yet are dropped, the running ones are waited for by the executor
+            for future in running:
+                future.cancel()
+
+            raise
+
+    return {
+        'results': results,
+        'timings': timings,
+        'critical_path': critical_path(jobs, timings),
+        'duration': time.monotonic() - started
+    }
+
+
+def check_graph(jobs: dict):
+    """ Internal function of run_pipeline(), fails on dependencies that are unknown or form a cycle
+    """
+
+    for name, job in jobs.items():
+        unknown = [after for after in job.get('after', ()) if after not in jobs]
+
+        if unknown:
+            raise ValueError(f'Job {name} depends on unknown jobs: {", ".join(unknown)}')
+
+    ordered: set = set()
+
+    while len(ordered) < len(jobs):
+        ready = [name for name, job in jobs.items() if name not in ordered and set(job.get('after', ())) <= ordered]
+
+        if not ready:
+            raise ValueError(f'Jobs depend on each other in a cycle: {", ".join(sorted(set(jobs) - ordered))}')
+
+        ordered.update(ready)
+
+
+def timed(function, arguments: list) -> tuple:
+    """ Internal function of run_pipeline(), runs a job in a worker
+        :return: Tuple of the result and the monotonic start and end time of the job
+    """
+
+    start = time.monotonic()
+    result = function(*arguments)
+
+    return result, start, time.monotonic()
+
+
+def critical_path(jobs: dict, timings: dict) -> list:
+    """ Finds the chain of dependent jobs that took the longest, the run can not be faster than this chain
+        :return path: The names of the jobs of the chain, in the order they ran
+    """
+
+    chains: dict = {}
+
+    def chain(name: str) -> tuple:
+        if name not in chains:
+            before = max((chain(after) for after in jobs[name].get('after', ())), default=(0.0, []))
+            start, end = timings[name]
+            chains[name] = (before[0] + end - start, before[1] + [name])
+
+        return chains[name]
+
+    return max((chain(name) for name in timings), default=(0.0, []))[1]
+
+
+def log_report(report: dict):
+    """ Logs the timings of the jobs of a pipeline run and its critical path
+    """
+
+    for name, (start, end) in sorted(report['timings'].items(), key=lambda timing: timing[1]):
+        logging.info(f'{name}: {start:.1f}s - {end:.1f}s ({end - start:.1f}s)')
+
+    path_duration = sum(report['timings'][name][1] - report['timings'][name][0] for name in report['critical_path'])
+    logging.info(
+        f'Critical path: {" -> ".join(report["critical_path"])} ({path_duration:.1f}s), '
+        f'run took {report["duration"]:.1f}s'
+    )
@@ -1,17 +1,47 @@
-from sqlalchemy import create_engine
+from sqlalchemy import UniqueConstraint, create_engine, text
+from sqlalchemy.engine import URL
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.dialects.postgresql import insert
 
+import logging
+import threading
+import zlib
 from configparser import ConfigParser
 from itertools import islice
 from datetime import datetime as dt
 
 # Import database models
 import model.countries
+import model.harvest_runs
 import model.organisations
+# Key of the DiSSCo network, harvested by default
+from gbif_networks import network_key
 
 
 current_month = dt.now().strftime('%B')
 
+# Connection pool of the shared engine, connections are checked before use as the database may have closed them
+# Compiled statements are kept per engine, so repeated queries skip compiling their SQL
+engine_options = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'query_cache_size': 500
+}
+
+engines: dict = {}
+engines_lock = threading.Lock()
+created_tables: set = set()
+migrated_tables: dict = {}
+
+# Columns of a unique constraint, as found in the database
+constraint_columns_query = text(
+    'SELECT attribute.attname FROM pg_constraint JOIN pg_attribute attribute '
+    'ON attribute.attrelid = pg_constraint.conrelid AND attribute.attnum = ANY(pg_constraint.conkey) '
+    'WHERE pg_constraint.conname = :name AND pg_constraint.conrelid = to_regclass(:table)'
+)
+
 # SonarLint constant: can be removed when GeoCASe organisations are automised
 # Temporary mapping between GBIF and GeoCASe
 organisation_mapping = {
@@ -26,29 +56,189 @@ organisation_mapping = {
 
 def database_config(filename='database.ini', section='postgresql'):
     """ Sets up the basic database connection rules fur further usage
+        The engine and its connection pool are created once per process and shared by all queries,
+        so connections and compiled statements are reused
         :return: db: instance of the database's properties
     """
 
-    # create a parser
+    with engines_lock:
+        if (filename, section) in engines:
+            return engines[filename, section]
+
+        # create a parser
+        parser = ConfigParser()
+        # read config file
+        parser.read(filename)
+
+        # get section, default to postgresql
+        db = {}
+        if parser.has_section(section):
+            params = parser.items(section)
+            for param in params:
+                db[param[0]] = param[1]
+
+        url = URL.create('postgresql+psycopg2', username=db['user'], password=db['password'], host=db['host'],
+                         database=db['database'])
+        engines[filename, section] = create_engine(url, echo=False, **engine_options)
+
+        return engines[filename, section]
+
+
+def database_configured(filename='database.ini', section='postgresql') -> bool:
+    """ Checks whether a database is set up, otherwise the harvest only writes csv files
+        :return: Whether the host, database and user are filled in
+    """
+
     parser = ConfigParser()
-    # read config file
     parser.read(filename)
 
-    # get section, default to postgresql
-    db = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            db[param[0]] = param[1]
+    return all(parser.get(section, option, fallback='') for option in ('host', 'database', 'user'))
+
+
+def lock_run(run_id: str, wait: bool):
+    """ Takes the Postgres advisory lock of a run, held by a connection of its own until unlock_run()
+        The lock is released by Postgres as well when the process dies
+        The connection autocommits, so it does not sit idle in a transaction for the whole run, which
+        idle_in_transaction_session_timeout would end along with the lock; the lock itself is held by the session
+        :param wait: Whether to wait until another process holding the lock releases it
+        :return: The connection holding the lock, or None when another process holds it
+    """
+
+    connection = database_config().connect().execution_options(isolation_level='AUTOCOMMIT')
+
+    if wait:
+        connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': lock_key(run_id)})
+
+        return connection
+
+    if connection.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': lock_key(run_id)}).scalar():
+        return connection
+
+    connection.close()
+
+    return None
+
+
+def unlock_run(run_id: str, connection):
+    """ Releases the advisory lock of a run taken by lock_run()
+    """
+
+    try:
+        connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': lock_key(run_id)})
+    except Exception:
+        # Never hand a connection that may still hold the lock back to the pool
+        connection.invalidate()
+        raise
+    finally:
+        connection.close()
+
+
+def lock_key(run_id: str) -> int:
+    """ Internal function, turns a run id into the number of its advisory lock
+        :return: The key of the lock
+    """
+
+    return zlib.crc32(run_id.encode('utf-8'))
+
+
+def create_table(db_config, table):
+    """ Internal function, creates a table when missing, checking so only once per process
+    """
+
+    with engines_lock:
+        if (db_config, table.name) in created_tables:
+            return
+
+    table.create(db_config, checkfirst=True)
+
+    with engines_lock:
+        created_tables.add((db_config, table.name))
+
+
+def migrate_network_key(db_config, table) -> bool:
+    """ Internal function, adds the network key to a table of a database from before several networks were harvested
+        Adds the column, filled with DiSSCo for the existing rows, and rebuilds the unique constraint of the model
+        that the upserts depend on, so the rows of one network never overwrite those of another
+        Checked once per process, processes doing so at the same time wait for each other
+        :return: Whether the unique constraint of the table includes the network key
+    """
+
+    with engines_lock:
+        if (db_config, table.name) in migrated_tables:
+            return migrated_tables[db_config, table.name]
 
-    database_config = create_engine('postgresql+psycopg2://' + db['user'] + ':' + db['password'] + '@' + db['host'] + '/' + db['database'], echo=False)
+    constraint = next(constraint for constraint in table.constraints if isinstance(constraint, UniqueConstraint))
+    columns = [column.name for column in constraint.columns]
 
-    return database_config
+    try:
+        with db_config.begin() as conn:
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': lock_key('migrate-network-key')})
+            conn.execute(text(
+                f'ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS network_key varchar(36) NOT NULL '
+                f"DEFAULT '{network_key}'"
+            ))
+            constrained = conn.execute(constraint_columns_query, {'name': constraint.name, 'table': table.name})
 
+            if set(constrained.scalars()) != set(columns):
+                logging.info(f'Adding the network key to the unique constraint {constraint.name} of {table.name}')
+                conn.execute(text(
+                    f'ALTER TABLE {table.name} DROP CONSTRAINT IF EXISTS {constraint.name}, '
+                    f'ADD CONSTRAINT {constraint.name} UNIQUE ({", ".join(columns)})'
+                ))
 
-def insert_countries_data(gbif_datasets, gbif_specimens, gbif_issues_flags, geocase_data):
+        migrated = True
+    except SQLAlchemyError as error:
+        logging.warning(f'Could not add the network key to {table.name}: {error}')
+        migrated = False
+
+    with engines_lock:
+        migrated_tables[db_config, table.name] = migrated
+
+    return migrated
+
+
+def check_network(db_config, table, network: str):
+    """ Internal function, refuses to insert the data of a network other than DiSSCo into a table that can not keep it
+    """
+
+    if not migrate_network_key(db_config, table) and network != network_key:
+        raise ValueError(f'The {table.name} table can not keep the data of network {network}, '
+                         f'its unique constraint does not include the network key')
+
+
+def insert_run_completed(run_id: str):
+    """ Records that a run completed, so runs of the same id that waited for it do not repeat it
+    """
+
+    db_config = database_config()
+    harvest_runs = model.harvest_runs.harvest_runs_model()
+    create_table(db_config, harvest_runs)
+
+    query = insert(harvest_runs).values(run_id=run_id, completed=dt.now())
+    query = query.on_conflict_do_update(index_elements=[harvest_runs.c.run_id], set_={harvest_runs.c.completed: dt.now()})
+
+    with db_config.begin() as conn:
+        conn.execute(query)
+
+
+def select_run_completed(run_id: str, since: dt) -> bool:
+    """ Checks whether a run completed since the given time
+        :return: Whether the run was recorded as completed since then
+    """
+
+    db_config = database_config()
+    harvest_runs = model.harvest_runs.harvest_runs_model()
+    create_table(db_config, harvest_runs)
+    query = harvest_runs.select().where(harvest_runs.c.run_id == run_id, harvest_runs.c.completed >= since)
+
+    with db_config.connect() as conn:
+        return conn.execute(query).first() is not None
+
+
+def insert_countries_data(gbif_datasets, gbif_specimens, gbif_issues_flags, geocase_data, network=network_key):
     """ Transforms the received countries' data to a standardised format
         Saves the formatted data in the database by insert or update
+        :param network: Key of the GBIF network the data belongs to
     """
 
     # Temporary mapping between GBIF and GeoCASe
@@ -61,6 +251,13 @@ def insert_countries_data(gbif_datasets, gbif_specimens, gbif_issues_flags, geoc
         'NL': 'The Netherlands'
     }
 
+    # Prepare database connection
+    db_config = database_config()
+
+    countries = model.countries.countries_model()
+    check_network(db_config, countries, network)
+    queries = []
+
     # For each organisation, prepare and save data to database
     for country in gbif_datasets['countries']:
         # Check if GeoCASe data from country is present
@@ -81,14 +278,10 @@ def insert_countries_data(gbif_datasets, gbif_specimens, gbif_issues_flags, geoc
                 'geocase': geocase_dummy
             },
             'issues_flags': gbif_issues_flags['countries'][country],
-            'month': current_month
+            'month': current_month,
+            'network_key': network
         }
 
-        # Prepare database connection
-        db_config = database_config()
-
-        countries = model.countries.countries_model()
-
         # Check if entity already exists (for same month) then upsert
         query = insert(countries).values(country_entity)
         query = query.on_conflict_do_update(
@@ -101,16 +294,27 @@ def insert_countries_data(gbif_datasets, gbif_specimens, gbif_issues_flags, geoc
             }
         )
 
-        # Execute query
-        with db_config.connect() as conn:
+        queries.append(query)
+
+    # Execute all queries over one pooled connection, in one transaction
+    with db_config.begin() as conn:
+        for query in queries:
             conn.execute(query)
 
 
-def insert_organisations_data(gbif_data, geocase_data):
+def insert_organisations_data(gbif_data, geocase_data, network=network_key):
     """ Transforms the received organisations' data to a standardised format
         Saves the formatted data in the database by insert or update
+        :param network: Key of the GBIF network the data belongs to
     """
 
+    # Prepare database connection
+    db_config = database_config()
+
+    organisations = model.organisations.organisations_model()
+    check_network(db_config, organisations, network)
+    queries = []
+
     # For each organisation, prepare and save data to database
     for organisation in gbif_data:
         # Check if GeoCASe data from organisation is present
@@ -134,14 +338,10 @@ def insert_organisations_data(gbif_data, geocase_data):
                 'geocase': geocase_dummy
             },
             'issues_flags': gbif_data[organisation]['issues_and_flags'],
-            'month': current_month
+            'month': current_month,
+            'network_key': network
         }
 
-        # Prepare database connection
-        db_config = database_config()
-
-        organisations = model.organisations.organisations_model()
-
         # Check if entity already exists (for same month) then upsert
         query = insert(organisations).values(organisation_entity)
         query = query.on_conflict_do_update(
@@ -154,14 +354,18 @@ def insert_organisations_data(gbif_data, geocase_data):
             }
         )
 
-        # Execute query
-        with db_config.connect() as conn:
+        queries.append(query)
+
+    # Execute all queries over one pooled connection, in one transaction
+    with db_config.begin() as conn:
+        for query in queries:
             conn.execute(query)
 
 
-def select_countries_data(request_list: list, month=current_month):
+def select_countries_data(request_list: list, month=current_month, network=network_key):
     """ Calls on data belonging to requested countries out of database
         Transforms the data to an usable format
+        :param network: Key of the GBIF network to select the data of
         :return: global_data: dictionary that possesses the reformed data
     """
 
@@ -179,11 +383,13 @@ def select_countries_data(request_list: list, month=current_month):
     db_config = database_config()
 
     countries = model.countries.countries_model()
-    query = countries.select().where(countries.c.month == month)
+    # The selects filter on the network key, which older databases do not have yet
+    migrate_network_key(db_config, countries)
+    query = countries.select().where(countries.c.month == month, countries.c.network_key == network)
 
     # Check if entity already exists (for same month)
     if request_list:
-        query = countries.select().where(countries.c.month == month, countries.c.country_code.in_(tuple(request_list)))
+        query = query.where(countries.c.country_code.in_(tuple(request_list)))
 
     with db_config.connect() as conn:
         countries_data = conn.execute(query).fetchall()
@@ -249,9 +455,10 @@ def select_countries_data(request_list: list, month=current_month):
     return global_data
 
 
-def select_organisations_data(request_list: list, month: str = current_month):
+def select_organisations_data(request_list: list, month: str = current_month, network: str = network_key):
     """ Calls on data belonging to requested organisations out of database
         Transforms the data to an usable format
+        :param network: Key of the GBIF network to select the data of
         :return: global_data: dictionary that possesses the reformed data
     """
 
@@ -259,11 +466,13 @@ def select_organisations_data(request_list: list, month: str = current_month):
     db_config = database_config()
 
     organisations = model.organisations.organisations_model()
-    query = organisations.select().where(organisations.c.month == month)
+    # The selects filter on the network key, which older databases do not have yet
+    migrate_network_key(db_config, organisations)
+    query = organisations.select().where(organisations.c.month == month, organisations.c.network_key == network)
 
     # Check if entity already exists (for same month)
     if request_list:
-        query = organisations.select().where(organisations.c.month == month, organisations.c.ror_id.in_(tuple(request_list)))
+        query = query.where(organisations.c.ror_id.in_(tuple(request_list)))
 
     with db_config.connect() as conn:
         organisations_data = conn.execute(query).fetchall()
@@ -0,0 +1,237 @@
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+# Directory of the cached responses, one file per canonical request url
+cache_directory = os.environ.get('HARVEST_CACHE_DIR', 'cache/responses')
+
+# Switch the cache off entirely, or ignore cached responses and fetch everything again
+# A forced refresh holds for every run of the process, or for a single run that sets it
+enabled = os.environ.get('HARVEST_CACHE', 'on') != 'off'
+force_refresh = contextvars.ContextVar(
+    'force_refresh', default=os.environ.get('HARVEST_FORCE_REFRESH', 'off') == 'on'
+)
+
+# Seconds a cached response is used without asking the API, by path prefix of the endpoint
+endpoint_ttls = {
+    '/v1/dataset/search': 24 * 3600,
+    '/v1/network/': 24 * 3600,
+    '/api/occurrence/breakdown': 12 * 3600,
+    '/api': 24 * 3600
+}
+default_ttl = 3600
+
+# Once the cache outgrows this size, the least recently used responses are removed until it is back to evict_to
+max_size = 256 * 1024 * 1024
+evict_to = 192 * 1024 * 1024
+
+# Bytes in the cache directory, counted once per process and kept up to date by the writes of this process
+cache_size = None
+cache_lock = threading.Lock()
+
+
+def cache_path(request_url: str) -> str:
+    """ Internal function, names the cache file of a canonical request url
+        :return: Path of the cache file
+    """
+
+    return os.path.join(cache_directory, hashlib.sha256(request_url.encode('utf-8')).hexdigest() + '.json')
+
+
+def ttl(request_url: str) -> int:
+    """ Finds the time to live of the endpoint, using the longest matching path prefix
+        :return: Number of seconds a response stays fresh
+    """
+
+    path = urlsplit(request_url).path
+    prefixes = [prefix for prefix in endpoint_ttls if path.startswith(prefix)]
+
+    if not prefixes:
+        return default_ttl
+
+    return endpoint_ttls[max(prefixes, key=len)]
+
+
+def lookup(request_url: str):
+    """ Reads the cached response of a canonical request url
+        :return entry: Dict of the cached body and validators, or None when not cached
+    """
+
+    if not enabled:
+        return None
+
+    try:
+        with open(cache_path(request_url), 'r', encoding='utf-8') as file:
+            entry = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    # Guard against hash collisions
+    if entry.get('url') != request_url:
+        return None
+
+    return entry
+
+
+def is_fresh(entry: dict) -> bool:
+    """ Checks if a cached response may be used without revalidating it
+        :return: True when the entry is within its time to live and no refresh is forced
+    """
+
+    return not force_refresh.get() and time.time() - entry['stored'] < ttl(entry['url'])
+
+
+def validators(entry: dict) -> dict:
+    """ Builds the conditional request headers out of the validators the API gave for the cached response
+        A forced refresh skips revalidation and always fetches the full response
+        :return headers: Dict of If-None-Match and If-Modified-Since headers
+    """
+
+    headers = {}
+
+    if force_refresh.get():
+        return headers
+
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    return headers
+
+
+def store(request_url: str, body: str, headers) -> dict:
+    """ Saves a response to the cache, then evicts old responses once the cache has grown too large
+        :param request_url: The canonical request url
+        :param body: The response body as text
+        :param headers: The response headers, to keep the validators
+        :return entry: The stored entry
+    """
+
+    entry = {
+        'url': request_url,
+        'stored': time.time(),
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'body': body
+    }
+
+    if enabled:
+        write_entry(entry)
+
+        if cache_size > max_size:
+            evict()
+
+    return entry
+
+
+def revalidated(entry: dict) -> dict:
+    """ Marks a cached response as fresh again, after the API answered 304 Not Modified
+        :return entry: The refreshed entry
+    """
+
+    entry['stored'] = time.time()
+
+    if enabled:
+        write_entry(entry)
+
+    return entry
+
+
+def write_entry(entry: dict):
+    """ Internal function, writes an entry atomically so concurrent readers never see half a file
+        Adds the change in size to the cache size
+    """
+
+    global cache_size
+
+    path = cache_path(entry['url'])
+    os.makedirs(cache_directory, exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(entry, file)
+
+    size = os.path.getsize(temporary_path)
+
+    with cache_lock:
+        if cache_size is None:
+            cache_size = sum(file_size for _, file_size, _ in cached_files())
+
+        try:
+            size -= os.path.getsize(path)
+        except OSError:
+            pass
+
+        os.replace(temporary_path, path)
+        cache_size += size
+
+
+def touch(request_url: str):
+    """ Marks a cached response as recently used, which keeps it from eviction
+    """
+
+    try:
+        os.utime(cache_path(request_url))
+    except OSError:
+        pass
+
+
+def cached_files() -> list:
+    """ Internal function, lists the cached responses
+        :return files: List of the last use, size and path of every cache file
+    """
+
+    files = []
+
+    with os.scandir(cache_directory) as entries:
+        for file in entries:
+            if file.name.endswith('.json'):
+                stat = file.stat()
+                files.append((stat.st_mtime, stat.st_size, file.path))
+
+    return files
+
+
+def evict():
+    """ Removes the least recently used responses until the cache fits within evict_to
+        The directory is scanned anew, as other processes may share the cache
+    """
+
+    global cache_size
+
+    with cache_lock:
+        files = cached_files()
+        size = sum(file_size for _, file_size, _ in files)
+
+        for _, file_size, path in sorted(files):
+            if size <= evict_to:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            size -= file_size
+
+        cache_size = size
+
+
+def clear():
+    """ Removes all cached responses
+    """
+
+    global cache_size
+
+    with cache_lock:
+        if os.path.isdir(cache_directory):
+            for file in os.listdir(cache_directory):
+                os.remove(os.path.join(cache_directory, file))
+
+        cache_size = None
@@ -0,0 +1,191 @@
+from typing import NamedTuple, Optional
+
+import msgspec
+
+
+# msgspec decodes a response body straight into the typed structures below, skipping the fields they do not name,
+# so no dicts and lists are built for the parts of a payload the harvest does not read
+loads = msgspec.json.decode
+
+
+# Compact structures holding only the fields of the GBIF and GeoCASe responses that the harvest uses
+# Datasets are decoded into them as is, the other responses are decoded into their wire layout and projected at once
+
+class Dataset(msgspec.Struct, rename='camel'):
+    key: str
+    publishing_country: Optional[str] = None
+    publishing_organization_key: Optional[str] = None
+
+
+class DatasetPage(msgspec.Struct):
+    count: int
+    results: list[Dataset]
+
+
+class FacetCounts(NamedTuple):
+    count: int
+    counts: dict
+
+
+class BreakdownRow(NamedTuple):
+    key: str
+    display_name: str
+    count: int
+    values: tuple
+
+
+class SolrFacets(NamedTuple):
+    num_found: int
+    fields: dict
+
+
+class PivotCounts(NamedTuple):
+    count: int
+    counts: dict
+
+
+class SolrPivots(NamedTuple):
+    num_found: int
+    pivots: dict
+
+
+class SolrPage(NamedTuple):
+    num_found: int
+    next_cursor_mark: str
+    docs: list
+
+
+# Wire layouts of the responses that are projected, naming only the fields that are read
+
+class FacetValue(msgspec.Struct):
+    name: str
+    count: int
+
+
+class Facet(msgspec.Struct):
+    counts: list[FacetValue]
+
+
+class FacetSearch(msgspec.Struct):
+    count: int
+    facets: list[Facet]
+
+
+class BreakdownResult(msgspec.Struct, rename='camel'):
+    count: int
+    filter: dict = {}
+    display_name: Optional[str] = None
+    values: tuple = ()
+
+
+class Breakdown(msgspec.Struct):
+    results: list[BreakdownResult]
+
+
+class SolrPivotRow(msgspec.Struct):
+    value: object
+    count: int
+    pivot: list['SolrPivotRow'] = []
+
+
+class SolrFacetCounts(msgspec.Struct):
+    facet_fields: dict[str, list] = {}
+    facet_pivot: dict[str, list[SolrPivotRow]] = {}
+
+
+class SolrResponse(msgspec.Struct, rename='camel'):
+    num_found: int
+    docs: list[dict] = []
+
+
+class SolrBody(msgspec.Struct, rename={'next_cursor_mark': 'nextCursorMark'}):
+    response: SolrResponse
+    facet_counts: SolrFacetCounts = msgspec.field(default_factory=SolrFacetCounts)
+    next_cursor_mark: Optional[str] = None
+
+
+dataset_page_decoder = msgspec.json.Decoder(DatasetPage)
+facet_search_decoder = msgspec.json.Decoder(FacetSearch)
+breakdown_decoder = msgspec.json.Decoder(Breakdown)
+solr_decoder = msgspec.json.Decoder(SolrBody)
+
+
+def decode_dataset_page(body) -> DatasetPage:
+    """ Decodes a page of the dataset search or the network constituents
+        :param body: The response body
+        :return: The count and the datasets of the page
+    """
+
+    return dataset_page_decoder.decode(body)
+
+
+def decode_facet_counts(body) -> FacetCounts:
+    """ Decodes a faceted dataset search with a single facet
+        :param body: The response body
+        :return: The total count and a dict of the count per facet value
+    """
+
+    search = facet_search_decoder.decode(body)
+
+    return FacetCounts(search.count, {
+        facet_value.name: facet_value.count for facet in search.facets for facet_value in facet.counts
+    })
+
+
+def decode_breakdown(body, filter_field: str = None) -> list:
+    """ Decodes a GBIF occurrence breakdown
+        :param body: The response body
+        :param filter_field: Field of the row filter that identifies the row, like publishing_country
+        :return: A list of the breakdown rows
+    """
+
+    return [
+        BreakdownRow(row.filter[filter_field] if filter_field else None, row.display_name, row.count, row.values)
+        for row in breakdown_decoder.decode(body).results
+    ]
+
+
+def decode_solr_facets(body) -> SolrFacets:
+    """ Decodes a GeoCASe Solr facet response, turning the flat arrays of values and counts into dicts in one pass
+        :param body: The response body
+        :return: The number of records found and a dict of the counts per value of each facet field
+    """
+
+    solr = solr_decoder.decode(body)
+    fields = {}
+
+    for field, facet in solr.facet_counts.facet_fields.items():
+        iterator = iter(facet)
+        fields[field] = dict(zip(iterator, iterator))
+
+    return SolrFacets(solr.response.num_found, fields)
+
+
+def decode_solr_pivots(body) -> SolrPivots:
+    """ Decodes a GeoCASe Solr facet pivot response of two fields in one pass
+        :param body: The response body
+        :return: The number of records found and per pivot a dict of the count of each value of the first field
+            with the counts per value of the second field
+    """
+
+    solr = solr_decoder.decode(body)
+    pivots = {}
+
+    for pivot, rows in solr.facet_counts.facet_pivot.items():
+        pivots[pivot] = {
+            row.value: PivotCounts(row.count, {nested.value: nested.count for nested in row.pivot})
+            for row in rows
+        }
+
+    return SolrPivots(solr.response.num_found, pivots)
+
+
+def decode_solr_page(body) -> SolrPage:
+    """ Decodes a page of GeoCASe Solr records requested with a cursor mark
+        :param body: The response body
+        :return: The number of records found, the cursor mark of the next page and the records, limited to the requested fields
+    """
+
+    solr = solr_decoder.decode(body)
+
+    return SolrPage(solr.response.num_found, solr.next_cursor_mark, solr.response.docs)
@@ -0,0 +1,123 @@
+import contextlib
+import fcntl
+import logging
+import os
+import re
+from datetime import datetime as dt
+
+# Internal functions
+import query_database
+
+
+# What a run does when a run of the same id is already going: 'wait' for it and reuse its results, or 'exit'
+on_conflict = os.environ.get('HARVEST_ON_CONFLICT', 'wait')
+
+# Directory of the lock files and completion markers of runs without a database
+lock_directory = os.environ.get('HARVEST_LOCK_DIR', 'locks')
+
+
+@contextlib.contextmanager
+def single_flight(run_id: str, rerun: bool = False):
+    """ Makes sure a run is harvested by one process at a time, across processes and pods
+        With a database a Postgres advisory lock is used, otherwise a file lock
+        A run that waited for another run of the same id reuses its results when that run completed meanwhile
+        :param run_id: Id of the run, like main2-2023-05
+        :param rerun: Whether to run after waiting even when the other run completed, like for a forced refresh
+        :return: Yields whether this process should run, False when another process did or does the work
+    """
+
+    database = query_database.database_configured()
+    wait = on_conflict == 'wait'
+    started = dt.now()
+    lock, waited = lock_database(run_id, wait) if database else lock_file(run_id, wait)
+
+    if lock is None:
+        logging.info(f'Run {run_id} is already going in another process, exiting')
+        yield False
+
+        return
+
+    try:
+        if waited and not rerun and completed_since(run_id, started, database):
+            logging.info(f'Run {run_id} was completed by another process, reusing its results')
+            yield False
+        else:
+            yield True
+    finally:
+        if database:
+            query_database.unlock_run(run_id, lock)
+        else:
+            lock.close()
+
+
+def complete(run_id: str):
+    """ Records that a run completed, to be called within single_flight() once all results are saved
+    """
+
+    if query_database.database_configured():
+        query_database.insert_run_completed(run_id)
+    else:
+        with open(lock_path(run_id, 'completed'), 'w', encoding='utf-8'):
+            pass
+
+
+def lock_database(run_id: str, wait: bool) -> tuple:
+    """ Internal function of single_flight(), takes the advisory lock of the run
+        :return: Tuple of the connection holding the lock, or None when another process holds it,
+            and whether it was waited for
+    """
+
+    connection = query_database.lock_run(run_id, wait=False)
+
+    if connection is not None or not wait:
+        return connection, False
+
+    logging.info(f'Run {run_id} is already going in another process, waiting for it')
+
+    return query_database.lock_run(run_id, wait=True), True
+
+
+def lock_file(run_id: str, wait: bool) -> tuple:
+    """ Internal function of single_flight(), takes the file lock of the run
+        :return: Tuple of the open lock file, or None when another process holds the lock,
+            and whether it was waited for
+    """
+
+    os.makedirs(lock_directory, exist_ok=True)
+    file = open(lock_path(run_id, 'lock'), 'a+', encoding='utf-8')
+
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        return file, False
+    except BlockingIOError:
+        if not wait:
+            file.close()
+
+            return None, False
+
+    logging.info(f'Run {run_id} is already going in another process, waiting for it')
+    fcntl.flock(file, fcntl.LOCK_EX)
+
+    return file, True
+
+
+def completed_since(run_id: str, since: dt, database: bool) -> bool:
+    """ Internal function of single_flight(), checks whether the run was completed by the run that was waited for
+        :return: Whether the run completed since the given time
+    """
+
+    if database:
+        return query_database.select_run_completed(run_id, since)
+
+    path = lock_path(run_id, 'completed')
+
+    return os.path.exists(path) and dt.fromtimestamp(os.path.getmtime(path)) >= since
+
+
+def lock_path(run_id: str, extension: str) -> str:
+    """ Internal function, names the lock file or completion marker of a run
+        :return: Path of the file
+    """
+
+    return os.path.join(lock_directory, re.sub(r'[^\w.=,-]', '_', run_id) + '.' + extension)
@@ -0,0 +1,132 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+from concurrent.futures import Future
+
+
+# File the results of a run are written to at its end for later inspection, not written when unset
+results_file = os.environ.get('HARVEST_RESULTS_FILE')
+
+# Results of the gather_* harvesters of the running process, per harvester and arguments
+results: dict = {}
+results_lock = threading.Lock()
+
+
+def memoized(ignore: tuple = (), answered_by: dict = None):
+    """ Decorator that runs a harvester at most once per run for the same arguments
+        Later and concurrent calls share the result of the first, so it must not be changed
+        :param ignore: Names of arguments that do not change the result, like the concurrency
+        :param answered_by: Per argument, the value whose result also answers a call with another value,
+            like {'monthly_progress': {False: True}} when the monthly result includes the totals
+    """
+
+    answered_by = answered_by or {}
+
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            values = {argument: value for argument, value in arguments.arguments.items() if argument not in ignore}
+
+            # A result of a more complete call answers this one too
+            keys = [result_key(values)] + [
+                result_key(values | {argument: alternatives[values[argument]]})
+                for argument, alternatives in answered_by.items() if values.get(argument) in alternatives
+            ]
+
+            with results_lock:
+                stored = results.setdefault(function.__name__, {})
+                future = next((stored[key] for key in keys if key in stored), None)
+
+                if future is None:
+                    future = stored[keys[0]] = Future()
+                    owner = True
+                else:
+                    owner = False
+
+            if not owner:
+                return future.result()
+
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as exception:
+                # A failed harvest is not kept, so the next call tries again
+                with results_lock:
+                    stored.pop(keys[0], None)
+
+                future.set_exception(exception)
+                raise
+
+            return future.result()
+
+        def remember(result, *args, **kwargs):
+            """ Keeps a result that was harvested elsewhere, like merged shards, as the result of a call
+            """
+
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            future = Future()
+            future.set_result(result)
+
+            with results_lock:
+                results.setdefault(function.__name__, {})[result_key({
+                    argument: value for argument, value in arguments.arguments.items() if argument not in ignore
+                })] = future
+
+        wrapper.remember = remember
+
+        return wrapper
+
+    return decorator
+
+
+def result_key(values: dict) -> str:
+    """ Internal function of memoized(), names the result of a call by its arguments
+        :return: The arguments as text
+    """
+
+    return ','.join(f'{argument}={value}' for argument, value in values.items()) or 'result'
+
+
+def persist(path: str = None):
+    """ Writes the completed results of the run to a JSON file for later inspection
+        :param path: Path of the file, defaults to HARVEST_RESULTS_FILE
+        :return path: Path of the written file, or None when there is no file to write to
+    """
+
+    path = path or results_file
+
+    if not path:
+        return None
+
+    with results_lock:
+        completed = {
+            harvester: {
+                key: future.result() for key, future in stored.items() if future.done() and not future.exception()
+            }
+            for harvester, stored in results.items()
+        }
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    with open(f'{path}.{os.getpid()}.tmp', 'w', encoding='utf-8') as file:
+        json.dump(completed, file, indent=2, default=str)
+
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+    logging.info(f'Results of the run were saved in: "{path}"')
+
+    return path
+
+
+def forget():
+    """ Drops the results at the end of a run, so the next run in the same process harvests anew
+    """
+
+    with results_lock:
+        results.clear()
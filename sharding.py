@@ -0,0 +1,175 @@
+import logging
+import os
+import pickle
+import shutil
+import time
+
+# Internal functions
+import deadlines
+import GBIF_functions
+
+
+# Number of shards the harvest is split over and the shard of this process
+# A Kubernetes Indexed Job sets the completion index of every pod, shard 0 merges all shards
+shard_count = int(os.environ.get('HARVEST_SHARDS', 1))
+shard_index = int(os.environ.get('JOB_COMPLETION_INDEX', os.environ.get('HARVEST_SHARD_INDEX', 0)))
+
+# Directory all shards write their partial results to, shared by the pods of the job
+shard_directory = os.environ.get('HARVEST_SHARD_DIR', 'shards')
+
+# Id of this attempt at the sharded run, shared by all its shards, so pod 0 never merges shards of an earlier attempt
+# The Kubernetes Job passes its uid, every Job the CronJob creates gets a new one
+attempt_id = os.environ.get('HARVEST_ATTEMPT_ID', 'local')
+
+# Seconds between looking for the partial results of the other shards, and the longest wait without a run deadline
+shard_poll_interval = 5
+shard_wait = 3600
+
+# Stages that fan out per country or publisher and are split over the shards
+sharded_stages = ['gather_issues_flags', 'gather_institutions']
+
+
+def shard_path(run_id: str, index: int, count: int) -> str:
+    """ Internal function, names the file of the partial results of a shard
+        :return: Path of the file
+    """
+
+    return os.path.join(shard_directory, run_id, attempt_id, f'shard-{index}-of-{count}.pickle')
+
+
+def harvest_shard(index: int, count: int, networks: list = None) -> dict:
+    """ Harvests the countries and publishers of one shard for every network
+        :param index: Index of the shard
+        :param count: Number of shards
+        :param networks: Keys of the GBIF networks, defaults to the configured networks
+        :return: A dict of each sharded stage to its partial result per network
+    """
+
+    return {
+        stage: GBIF_functions.harvest_networks(getattr(GBIF_functions, stage), networks, shard=(index, count))
+        for stage in sharded_stages
+    }
+
+
+def write_shard(run_id: str, index: int, count: int, partial_results: dict) -> str:
+    """ Writes the partial results of a shard, replacing the file at once so the merge never reads half a file
+        :return path: Path of the written file
+    """
+
+    path = shard_path(run_id, index, count)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(f'{path}.{os.getpid()}.tmp', 'wb') as file:
+        pickle.dump(partial_results, file)
+
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    return path
+
+
+def read_shards(run_id: str, count: int, wait: float = None) -> list:
+    """ Waits until all shards of the run have written their partial results and reads them
+        :param wait: Most seconds to wait, defaults to the time left in the run or shard_wait
+        :return: The partial results, in the order of the shards
+    """
+
+    left = deadlines.remaining()
+    end = time.monotonic() + (wait or (left if left is not None else shard_wait))
+    paths = [shard_path(run_id, index, count) for index in range(count)]
+
+    while True:
+        missing = [path for path in paths if not os.path.exists(path)]
+
+        if not missing:
+            break
+
+        if time.monotonic() >= end:
+            raise deadlines.DeadlineExceeded(f'Shards did not complete in time: {", ".join(missing)}')
+
+        time.sleep(shard_poll_interval)
+
+    partial_results = []
+
+    for path in paths:
+        with open(path, 'rb') as file:
+            partial_results.append(pickle.load(file))
+
+    return partial_results
+
+
+def merge_shards(partial_results: list) -> dict:
+    """ Combines the partial results of all shards into the results of an unsharded harvest
+        Shards are merged in the order of their index, so the result does not depend on which shard finished first
+        :param partial_results: The partial results of every shard
+        :return merged: A dict of each sharded stage to its result per network
+    """
+
+    merged: dict = {}
+
+    for partial_result in partial_results:
+        for stage, per_network in partial_result.items():
+            for network, result in per_network.items():
+                stage_results = merged.setdefault(stage, {})
+                stage_results[network] = merge_functions[stage](stage_results.get(network), result)
+
+    return merged
+
+
+def merge_issues_flags(issues_and_flags, shard_issues_and_flags: dict) -> dict:
+    """ Internal function of merge_shards(), adds the countries of a shard to the issues and flags
+        :return issues_and_flags: The merged issues and flags
+    """
+
+    if issues_and_flags is None:
+        return {'total': shard_issues_and_flags['total'], 'countries': dict(shard_issues_and_flags['countries'])}
+
+    issues_and_flags['total'] += shard_issues_and_flags['total']
+    issues_and_flags['countries'] |= shard_issues_and_flags['countries']
+
+    return issues_and_flags
+
+
+def merge_institutions(publishers, shard_publishers: dict) -> dict:
+    """ Internal function of merge_shards(), adds the publishers of a shard to the publishers
+        :return publishers: The merged publishers
+    """
+
+    return (publishers or {}) | shard_publishers
+
+
+merge_functions = {
+    'gather_issues_flags': merge_issues_flags,
+    'gather_institutions': merge_institutions
+}
+
+
+def remember(merged: dict):
+    """ Keeps the merged results as the results of the sharded stages in this run, so they are not harvested again
+    """
+
+    for stage, per_network in merged.items():
+        for network, result in per_network.items():
+            getattr(GBIF_functions, stage).remember(result, network=network)
+
+
+def clear(run_id: str):
+    """ Removes the partial results of earlier attempts at the run, before this attempt harvests its shard
+    """
+
+    run_directory = os.path.join(shard_directory, run_id)
+
+    if not os.path.isdir(run_directory):
+        return
+
+    for attempt in os.listdir(run_directory):
+        if attempt != attempt_id:
+            shutil.rmtree(os.path.join(run_directory, attempt), ignore_errors=True)
+            logging.info(f'Removed the shards of attempt {attempt} of run {run_id}')
+
+
+def remove(run_id: str):
+    """ Removes the partial results of all shards once the run has completed
+    """
+
+    shutil.rmtree(os.path.join(shard_directory, run_id), ignore_errors=True)
+    logging.info(f'Removed the shards of run {run_id}')